@@ -0,0 +1,255 @@
+import argparse
+import json
+import platform
+import sys
+import timeit
+from dataclasses import make_dataclass
+from enum import Enum
+from typing import Annotated, Any, Callable, Optional
+
+import google.protobuf
+from google.protobuf.internal import api_implementation
+
+import tahutils
+from tahutils import MetricDataType, SpbModel
+from tahutils.parse import parse_payload_to_metric_list, payload_from_string
+from tahutils.tahu import array_packer as ap
+
+"""
+Benchmarks the hot paths of tahutils: building birth and data payloads from dict, enum and dataclass states, parsing payloads,
+and packing and un-packing every array type. Sweeps metric counts, the fraction of metrics changed per data payload, and datatypes.
+
+Results are written as JSON, one record per benchmark. A previous run can be given with --compare to fail (exit code 1) when any
+benchmark is slower than it by more than --tolerance, so protobuf or tahutils upgrades can be gated on it:
+	python benchmarks/suite.py --output baseline.json
+	python benchmarks/suite.py --compare baseline.json
+"""
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# Dataclass states annotate fields with MetricDataType values, which are ints. Annotated only accepts them from Python 3.12,
+# so dataclass inputs are skipped on earlier versions.
+INPUT_KINDS = ("enum", "dataclass") if sys.version_info >= (3, 12) else ("enum",)
+
+# The value of metric i in each of two states, so that data payloads can alternate between them
+DATATYPES: dict[str, tuple[int, Callable[[int, int], Any]]] = {
+	"Int32": (MetricDataType.Int32, lambda i, variant: i + variant),
+	"Int64": (MetricDataType.Int64, lambda i, variant: -(i << 33) - variant),
+	"Float": (MetricDataType.Float, lambda i, variant: i * 0.5 + variant),
+	"Double": (MetricDataType.Double, lambda i, variant: i * 0.25 + variant),
+	"Boolean": (MetricDataType.Boolean, lambda i, variant: (i + variant) % 2 == 0),
+	"String": (MetricDataType.String, lambda i, variant: f"value {i} {variant}"),
+	"DoubleArray": (MetricDataType.DoubleArray, lambda i, variant: [i * 0.5 + variant] * 8),
+}
+
+# Each packer with a function generating an input array of the given length
+PACKERS: dict[str, tuple[Callable, Callable, Callable[[int], list]]] = {
+	"int8": (ap.convert_to_packed_int8_array, ap.convert_from_packed_int8_array, lambda n: [i % 256 - 128 for i in range(n)]),
+	"int16": (ap.convert_to_packed_int16_array, ap.convert_from_packed_int16_array, lambda n: [i % 65536 - 32768 for i in range(n)]),
+	"int32": (ap.convert_to_packed_int32_array, ap.convert_from_packed_int32_array, lambda n: [i - n // 2 for i in range(n)]),
+	"int64": (ap.convert_to_packed_int64_array, ap.convert_from_packed_int64_array, lambda n: [(i - n // 2) << 32 for i in range(n)]),
+	"uint8": (ap.convert_to_packed_uint8_array, ap.convert_from_packed_uint8_array, lambda n: [i % 256 for i in range(n)]),
+	"uint16": (ap.convert_to_packed_uint16_array, ap.convert_from_packed_uint16_array, lambda n: [i % 65536 for i in range(n)]),
+	"uint32": (ap.convert_to_packed_uint32_array, ap.convert_from_packed_uint32_array, lambda n: list(range(n))),
+	"uint64": (ap.convert_to_packed_uint64_array, ap.convert_from_packed_uint64_array, lambda n: [i << 32 for i in range(n)]),
+	"float": (ap.convert_to_packed_float_array, ap.convert_from_packed_float_array, lambda n: [i * 0.5 for i in range(n)]),
+	"double": (ap.convert_to_packed_double_array, ap.convert_from_packed_double_array, lambda n: [i * 0.25 for i in range(n)]),
+	"boolean": (ap.convert_to_packed_boolean_array, ap.convert_from_packed_boolean_array, lambda n: [i % 3 == 0 for i in range(n)]),
+	"string": (ap.convert_to_packed_string_array, ap.convert_from_packed_string_array, lambda n: [f"s{i}" for i in range(n)]),
+	"datetime": (ap.convert_to_packed_datetime_array, ap.convert_from_packed_datetime_array, lambda n: [1700000000000 + i for i in range(n)]),
+}
+# Packers whose un-packing takes `as_view`, and NumPy dtypes for packing ndarrays
+AS_VIEW_PACKERS = set(PACKERS) - {"string"}
+NUMPY_DTYPES = {
+	"int8": "int8", "int16": "int16", "int32": "int32", "int64": "int64",
+	"uint8": "uint8", "uint16": "uint16", "uint32": "uint32", "uint64": "uint64",
+	"float": "float32", "double": "float64", "boolean": "bool", "datetime": "uint64",
+}
+
+
+def measure(fn: Callable[[], Any], min_time: float, repeat: int) -> float:
+	"""Returns the best time in seconds of a single call of fn"""
+	timer = timeit.Timer(fn)
+	# The first call warms up any caches, and calibrates the number of calls per timing
+	elapsed = timer.timeit(number=1)
+	number = max(1, int(min_time / max(elapsed, 1e-9)))
+	return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def metric_names(n: int) -> list[str]:
+	return [f"Area{i // 1000}/Line{i // 100 % 10}/Metric{i}" for i in range(n)]
+
+def make_inputs(kind: str, n: int, datatype: str):
+	"""Returns the model metrics and a function building the state of each variant, for dict, enum or dataclass inputs"""
+	dtype, value = DATATYPES[datatype]
+	names = metric_names(n)
+	if kind == "dict":
+		return {name: dtype for name in names}, lambda variant, changed: {
+			name: value(i, variant if i < changed else 0) for i, name in enumerate(names)
+		}
+	if kind == "enum":
+		members = Enum("Metrics", {f"m{i}": name for i, name in enumerate(names)})
+		return {m: dtype for m in members}, lambda variant, changed: {
+			m: value(i, variant if i < changed else 0) for i, m in enumerate(members)
+		}
+	if kind == "dataclass":
+		# Nested in groups of 500 fields, keeping generated classes a reasonable size
+		groups = [range(start, min(start + 500, n)) for start in range(0, n, 500)]
+		group_classes = [
+			make_dataclass(f"Group{g}", [(f"m{i}", Annotated[dtype, f"Metric{i}"]) for i in group])
+			for g, group in enumerate(groups)
+		]
+		cls = make_dataclass("State", [(f"g{g}", Annotated[c, f"Group{g}"]) for g, c in enumerate(group_classes)])
+		return cls, lambda variant, changed: cls(*(
+			c(*(value(i, variant if i < changed else 0) for i in group))
+			for c, group in zip(group_classes, groups)
+		))
+	raise ValueError(f"Unknown input kind {kind}")
+
+def new_model(metrics) -> SpbModel:
+	model = SpbModel(metrics, use_aliases=True, serialize_cast=None)
+	model.getDeathPayload()
+	return model
+
+def bench_model(kind: str, n: int, datatype: str, change_ratios: list[float], min_time: float, repeat: int) -> list[dict]:
+	"""Benchmarks births and data payloads built from the given kind of state"""
+	metrics, state = make_inputs(kind, n, datatype)
+	model = new_model(metrics)
+	full = state(0, n)
+	results = [{
+		"benchmark": "getBirthPayload",
+		"input": kind,
+		"datatype": datatype,
+		"metrics": n,
+		"seconds": measure(lambda: model.getBirthPayload(full), min_time, repeat),
+	}]
+	for ratio in change_ratios:
+		changed = max(1, round(n * ratio))
+		states = [state(0, changed), state(1, changed)]
+		model.getBirthPayload(states[0])
+		calls = iter(range(1 << 62))
+		results.append({
+			"benchmark": "getDataPayload",
+			"input": kind,
+			"datatype": datatype,
+			"metrics": n,
+			"change_ratio": ratio,
+			"seconds": measure(lambda: model.getDataPayload(states[next(calls) % 2]), min_time, repeat),
+		})
+	return results
+
+def bench_parse(n: int, datatype: str, min_time: float, repeat: int) -> list[dict]:
+	"""Benchmarks parsing a serialized birth payload"""
+	metrics, state = make_inputs("dict", n, datatype)
+	data = bytes(new_model(metrics).getBirthPayload(state(0, n)))
+	return [{
+		"benchmark": "parse_payload_to_metric_list",
+		"datatype": datatype,
+		"metrics": n,
+		"bytes": len(data),
+		"seconds": measure(lambda: parse_payload_to_metric_list(payload_from_string(data)), min_time, repeat),
+	}]
+
+def bench_packers(length: int, min_time: float, repeat: int) -> list[dict]:
+	"""Benchmarks packing and un-packing each array type, from lists and ndarrays, and to tuples and views"""
+	results = []
+	for name, (pack, unpack, make) in PACKERS.items():
+		values = make(length)
+		packed = pack(values)
+		inputs = [("list", values)]
+		if np is not None and name in NUMPY_DTYPES:
+			inputs.append(("ndarray", np.array(values, dtype=NUMPY_DTYPES[name])))
+		for input_kind, array in inputs:
+			results.append({
+				"benchmark": pack.__name__,
+				"input": input_kind,
+				"length": length,
+				"seconds": measure(lambda: pack(array), min_time, repeat),
+			})
+		outputs = [("tuple", lambda: unpack(packed))]
+		if name in AS_VIEW_PACKERS:
+			outputs.append(("view", lambda: unpack(packed, as_view=True)))
+		for output_kind, fn in outputs:
+			results.append({
+				"benchmark": unpack.__name__,
+				"output": output_kind,
+				"length": length,
+				"seconds": measure(fn, min_time, repeat),
+			})
+	return results
+
+def environment() -> dict[str, Any]:
+	return {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"protobuf": google.protobuf.__version__,
+		"protobuf_backend": api_implementation.Type(),
+		"numpy": np.__version__ if np is not None else None,
+		"tahutils": tahutils.__version__,
+	}
+
+def result_key(result: dict) -> tuple:
+	return tuple(sorted((k, v) for k, v in result.items() if k not in ("seconds", "per_second", "bytes")))
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+	"""Returns a description of each benchmark slower than the baseline by more than the tolerance"""
+	baseline_seconds = {result_key(r): r["seconds"] for r in baseline}
+	regressions = []
+	for r in results:
+		before = baseline_seconds.get(result_key(r))
+		if before is not None and r["seconds"] > before * (1 + tolerance):
+			regressions.append(f"{dict(result_key(r))}: {before * 1e6:.1f}us -> {r['seconds'] * 1e6:.1f}us")
+	return regressions
+
+def main(argv: Optional[list[str]] = None) -> int:
+	parser = argparse.ArgumentParser(description="Benchmarks tahutils encoding, parsing and array packing")
+	parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 1000, 10000, 50000], help="metric counts to sweep")
+	parser.add_argument("--change-ratios", type=float, nargs="+", default=[0.01, 0.1, 1.0], help="fractions of metrics changed per data payload")
+	parser.add_argument("--datatypes", nargs="+", default=list(DATATYPES), choices=list(DATATYPES))
+	parser.add_argument("--array-lengths", type=int, nargs="+", default=[10, 1000, 100000])
+	parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per timing")
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--quick", action="store_true", help="a small sweep, for smoke testing")
+	parser.add_argument("--output", help="file to write the JSON results to, instead of stdout")
+	parser.add_argument("--compare", help="JSON results of a previous run to check for regressions")
+	parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown relative to --compare")
+	args = parser.parse_args(argv)
+	if args.quick:
+		args.counts, args.change_ratios, args.datatypes = [10, 1000], [0.1], ["Float", "String"]
+		args.array_lengths, args.min_time, args.repeat = [1000], 0.02, 1
+
+	if "dataclass" not in INPUT_KINDS:
+		print("Skipping dataclass inputs, which need Python 3.12 or later", file=sys.stderr)
+	results = []
+	for n in args.counts:
+		print(f"Benchmarking {n} metrics", file=sys.stderr)
+		for datatype in args.datatypes:
+			results += bench_model("dict", n, datatype, args.change_ratios, args.min_time, args.repeat)
+			results += bench_parse(n, datatype, args.min_time, args.repeat)
+		for kind in INPUT_KINDS:
+			results += bench_model(kind, n, "Float", args.change_ratios, args.min_time, args.repeat)
+	for length in args.array_lengths:
+		print(f"Benchmarking arrays of {length}", file=sys.stderr)
+		results += bench_packers(length, args.min_time, args.repeat)
+
+	for r in results:
+		r["per_second"] = (r.get("metrics") or r["length"]) / r["seconds"]
+	output = json.dumps({"environment": environment(), "results": results}, indent="\t")
+	if args.output:
+		with open(args.output, "w", encoding="utf-8") as f:
+			f.write(output)
+	else:
+		print(output)
+
+	if args.compare:
+		with open(args.compare, "r", encoding="utf-8") as f:
+			regressions = compare(results, json.load(f)["results"], args.tolerance)
+		for regression in regressions:
+			print(f"Regression: {regression}", file=sys.stderr)
+		return 1 if regressions else 0
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,106 @@
+import random
+import timeit
+
+from tahutils import MetricDataType, SpbModel
+
+"""
+Compares data payloads written straight to the wire format against payloads built with the protobuf classes.
+Before timing, checks that both produce identical bytes across every scalar and array datatype, with and without aliases.
+"""
+
+VALUES = {
+	MetricDataType.Int8: lambda: random.randint(-128, 127),
+	MetricDataType.Int16: lambda: random.randint(-2**15, 2**15 - 1),
+	MetricDataType.Int32: lambda: random.randint(-2**31, 2**31 - 1),
+	MetricDataType.Int64: lambda: random.randint(-2**63, 2**63 - 1),
+	MetricDataType.UInt8: lambda: random.randint(0, 255),
+	MetricDataType.UInt16: lambda: random.randint(0, 2**16 - 1),
+	MetricDataType.UInt32: lambda: random.randint(0, 2**32 - 1),
+	MetricDataType.UInt64: lambda: random.randint(0, 2**64 - 1),
+	MetricDataType.Float: lambda: random.uniform(-1e6, 1e6),
+	MetricDataType.Double: lambda: random.uniform(-1e12, 1e12),
+	MetricDataType.Boolean: lambda: random.random() < 0.5,
+	MetricDataType.String: lambda: random.choice(["", "a", "ünïcödé", "x" * 300]),
+	MetricDataType.DateTime: lambda: random.randint(0, 2**41),
+	MetricDataType.Text: lambda: "text",
+	MetricDataType.UUID: lambda: "8c1b2e7e-5b1f-4d4e-9d7a-3a3c6f9a1b2c",
+	MetricDataType.Bytes: lambda: random.randbytes(random.randint(0, 200)),
+	MetricDataType.Int32Array: lambda: [random.randint(-2**31, 2**31 - 1) for _ in range(5)],
+	MetricDataType.DoubleArray: lambda: [random.random() for _ in range(5)],
+	MetricDataType.BooleanArray: lambda: [random.random() < 0.5 for _ in range(9)],
+	MetricDataType.StringArray: lambda: ["a", "bc", ""],
+}
+
+OUT_OF_RANGE = [
+	(MetricDataType.Int8, -300),
+	(MetricDataType.Int32, -2**33),
+	(MetricDataType.Int64, -2**65),
+	(MetricDataType.UInt8, -1),
+	(MetricDataType.UInt16, -1),
+	(MetricDataType.UInt32, 2**33),
+	(MetricDataType.UInt64, -1),
+	(MetricDataType.UInt64, 2**64),
+	(MetricDataType.DateTime, -1),
+]
+
+def make_models(metrics, **kwargs):
+	models = []
+	for wire_encoding in (False, True):
+		model = SpbModel(metrics, wire_encoding=wire_encoding, serialize_cast=None, clock=lambda: 1700000000000, **kwargs)
+		model.getDeathPayload()
+		models.append(model)
+	return models
+
+def check_equivalence(rounds=200):
+	"""Asserts that both encoders produce byte-identical payloads"""
+	metrics = {f"Type{datatype}/{i}": datatype for datatype in VALUES for i in range(3)}
+	for kwargs in ({}, {"use_aliases": True}, {"use_aliases": True, "alias_only_data": True}, {"omit_metric_timestamps": True}):
+		protobuf, wire = make_models(metrics, **kwargs)
+		state = {metric: VALUES[datatype]() for metric, datatype in metrics.items()}
+		protobuf.getBirthPayload(state)
+		wire.getBirthPayload(state)
+		for _ in range(rounds):
+			state = {
+				metric: None if random.random() < 0.05 else VALUES[datatype]()
+				for metric, datatype in metrics.items()
+				if random.random() < 0.5
+			}
+			times = {metric: random.randint(0, 2**41) for metric in state if random.random() < 0.2}
+			expected = protobuf.getDataPayload(state, times)
+			actual = wire.getDataPayload(state, times)
+			assert actual == expected, (kwargs, state)
+
+	# Values outside a datatype's range are rejected by both
+	for datatype, value in OUT_OF_RANGE:
+		for model in make_models({"Value": datatype}):
+			model.getBirthPayload({"Value": 0})
+			try:
+				model.getDataPayload({"Value": value})
+			except ValueError:
+				continue
+			raise AssertionError(f"{value} was encoded as {datatype}, wire encoding {model._wire is not None}")
+
+def benchmark(n_metrics=1000, number=200):
+	metrics = {f"Line/Machine{i}/Value": [MetricDataType.Float, MetricDataType.Int32, MetricDataType.Boolean][i % 3] for i in range(n_metrics)}
+	protobuf, wire = make_models(metrics, use_aliases=True)
+	values = [
+		{metric: VALUES[datatype]() for metric, datatype in metrics.items()}
+		for _ in range(2)
+	]
+	protobuf.getBirthPayload(values[0])
+	wire.getBirthPayload(values[0])
+
+	for name, model in (("protobuf", protobuf), ("wire", wire)):
+		i = iter(range(number * 2))
+		t = timeit.timeit(lambda: model.getDataPayload(values[next(i) % 2]), number=number)
+		print(f"{name:>8}: {t / number * 1e3:.3f} ms per {n_metrics} metric data payload")
+
+def main():
+	random.seed(0)
+	check_equivalence()
+	print("Wire encoded payloads are identical to protobuf encoded payloads")
+	for n_metrics in (10, 1000, 10000):
+		benchmark(n_metrics, number=max(10, 100000 // n_metrics))
+
+if __name__ == "__main__":
+	main()
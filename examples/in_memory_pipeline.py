@@ -0,0 +1,60 @@
+import asyncio
+import time
+from collections import Counter
+
+from tahutils import MetricDataType, SpbHostModel, SpbModel, SpbTopic
+from tahutils.broker import Broker
+from tahutils.edge import EdgeNode
+from tahutils.utils import current_time_ms
+
+"""
+Runs an edge node with many devices against an in-memory broker, and a host application consuming its messages, without a network.
+Prints the throughput and a histogram of the delay between each payload's timestamp and its arrival at the host.
+"""
+
+async def main(n_devices: int = 1000, n_rounds: int = 20):
+	broker = Broker()
+
+	# The host application tracks every node on the broker
+	hosts: dict[tuple[str, str], SpbHostModel] = {}
+	latencies = Counter()
+	received = 0
+	def on_message(topic: str, payload: bytes):
+		nonlocal received
+		parsed = SpbTopic.parse(topic)
+		host = hosts.setdefault((parsed.group_id, parsed.edge_node_id), SpbHostModel())
+		metrics = host.ingest(parsed.message_type, payload, parsed.device_id)
+		if metrics:
+			latencies[current_time_ms() - metrics[0].timestamp] += 1
+		received += 1
+
+	host_client = broker.client("host")
+	await host_client.connect()
+	await host_client.subscribe("spBv1.0/#", on_message)
+
+	node_model = SpbModel({"Steps": MetricDataType.Int32}, use_aliases=True, serialize_cast=bytes)
+	node = EdgeNode(SpbTopic("pipeline", "Node"), node_model, broker.client("node"), publish_interval=0.01)
+	for i in range(n_devices):
+		node.addDevice(
+			f"Device{i}",
+			SpbModel({"Count": MetricDataType.Int32, "Temperature": MetricDataType.Float}, use_aliases=True, is_device=True, node=node_model, serialize_cast=bytes)
+		)
+
+	start = time.perf_counter()
+	await node.start({"Steps": 0}, {f"Device{i}": {"Count": 0, "Temperature": 20.0} for i in range(n_devices)})
+	for step in range(1, n_rounds + 1):
+		node.update({"Steps": step})
+		for i in range(n_devices):
+			node.update({"Count": step, "Temperature": 20.0 + step / 10}, f"Device{i}")
+		await asyncio.sleep(0.01)
+	await node.stop()
+	elapsed = time.perf_counter() - start
+
+	print(f"{broker.published} messages published, {received} received in {elapsed:.2f}s ({received / elapsed:.0f} msgs/s)")
+	print("Delay from payload timestamp to arrival (ms): count")
+	for latency, count in sorted(latencies.items()):
+		print(f"{latency:>5}: {count}")
+
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -32,7 +32,8 @@ def main():
 		SpbModel(
 			DeviceData,
 			serialize_cast=bytes,
-			is_device=True
+			is_device=True,
+			node=node_model
 		) for _ in range(n_devices)
 	]
 	node_topic = SpbTopic("testgroup", "TestNodeWithDevices")
@@ -1,8 +1,22 @@
 __version__ = "0.1.8"
 
 from . import tahu
-from tahutils.spb import SpbModel, SpbTopic, COMMAND_METRICS_SET, CommandMetric
+from tahutils.spb import SpbModel, SpbTopic, ParsedTopic, COMMAND_METRICS_SET, CommandMetric
+from tahutils.sequence import SequenceCounter
+from tahutils.deadband import Deadband
+from tahutils.compression import Compression
+from tahutils.buffers import PayloadBuffer
+from tahutils.instrumentation import Instrumentation
+from tahutils.host import SpbHostModel
+from tahutils.router import TopicRouter
 from tahutils.tahu.sparkplug_b import MetricDataType 
 from . import utils
 from . import types
-from . import parse
\ No newline at end of file
+from . import parse
+from . import host
+from . import compression
+from . import buffers
+from . import router
+from . import edge
+from . import broker
+from . import instrumentation
\ No newline at end of file
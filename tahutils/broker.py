@@ -0,0 +1,103 @@
+from typing import Any, Callable, Optional
+
+from tahutils.router import TopicRouter, topic_matches, validate_pattern
+
+
+Callback = Callable[[str, bytes], Any]
+
+class Broker:
+	"""An in-process stand-in for an MQTT broker, for tests and benchmarks without a network.
+
+	Messages are delivered synchronously, within `publish`, to the callbacks of every subscription with a matching topic filter
+	(`+` and `#` wildcards are supported). Retained messages are kept per topic and delivered on subscription, and publishing an
+	empty retained message clears the topic. The will of a client is published if it is disconnected by `drop` rather than
+	disconnecting cleanly. QoS levels are accepted but every message is delivered exactly once.
+	"""
+
+	def __init__(self) -> None:
+		self._subscriptions = TopicRouter()
+		self.retained: dict[str, bytes] = {}
+		self.clients: dict[str, "BrokerClient"] = {}
+		self.published = 0
+		self.delivered = 0
+
+	def client(self, client_id: str) -> "BrokerClient":
+		"""Returns a new client of the broker"""
+		return BrokerClient(self, client_id)
+
+	def publish(self, topic: str, payload: bytes, retain: bool = False) -> int:
+		"""Delivers a message to the matching subscriptions, and returns the number of deliveries"""
+		if "+" in topic or "#" in topic:
+			raise ValueError(f"Wildcards can't be published to, got topic {topic}")
+		if retain:
+			if payload:
+				self.retained[topic] = payload
+			else:
+				self.retained.pop(topic, None)
+		self.published += 1
+		delivered = self._subscriptions.dispatch(topic, payload)
+		self.delivered += delivered
+		return delivered
+
+	def subscribe(self, pattern: str, callback: Callback) -> None:
+		"""Subscribes the callback to topics matching the filter, and delivers the matching retained messages to it"""
+		validate_pattern(pattern)
+		self._subscriptions.add(pattern, callback)
+		for topic, payload in list(self.retained.items()):
+			if topic_matches(pattern, topic):
+				callback(topic, payload)
+
+	def unsubscribe(self, pattern: str, callback: Callback) -> bool:
+		"""Removes a subscription, returning whether it existed"""
+		return self._subscriptions.remove(pattern, callback)
+
+
+class BrokerClient:
+	"""A client of an in-memory Broker, usable as an EdgeNode transport and by host applications"""
+
+	def __init__(self, broker: Broker, client_id: str) -> None:
+		self.broker = broker
+		self.client_id = client_id
+		self.connected = False
+		self.will: Optional[tuple[str, bytes]] = None
+		self.subscriptions: list[tuple[str, Callback]] = []
+
+	async def connect(self, will_topic: Optional[str] = None, will_payload: Optional[bytes] = None) -> None:
+		"""Connects, replacing any other client with the same id as an MQTT broker would"""
+		previous = self.broker.clients.get(self.client_id)
+		if previous is not None and previous is not self:
+			previous.drop()
+		self.will = (will_topic, will_payload) if will_topic is not None else None
+		self.connected = True
+		self.broker.clients[self.client_id] = self
+
+	async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False) -> None:
+		if not self.connected:
+			raise ConnectionError(f"Client {self.client_id} is not connected")
+		self.broker.publish(topic, payload, retain)
+
+	async def subscribe(self, pattern: str, callback: Callback) -> None:
+		if not self.connected:
+			raise ConnectionError(f"Client {self.client_id} is not connected")
+		self.subscriptions.append((pattern, callback))
+		self.broker.subscribe(pattern, callback)
+
+	async def disconnect(self) -> None:
+		"""Disconnects cleanly, discarding the will"""
+		self._close()
+
+	def drop(self) -> None:
+		"""Disconnects as if the connection was lost, publishing the will"""
+		will = self.will
+		self._close()
+		if will is not None:
+			self.broker.publish(*will)
+
+	def _close(self) -> None:
+		for pattern, callback in self.subscriptions:
+			self.broker.unsubscribe(pattern, callback)
+		self.subscriptions.clear()
+		self.will = None
+		self.connected = False
+		if self.broker.clients.get(self.client_id) is self:
+			del self.broker.clients[self.client_id]
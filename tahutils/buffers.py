@@ -0,0 +1,58 @@
+from array import array
+from typing import Union
+
+from tahutils.tahu import sparkplug_b as spb
+
+
+def serialize_into(payload: Union[spb.Payload, bytes, bytearray, memoryview], buffer, offset: int = 0) -> int:
+	"""Writes the serialized payload into a writable buffer (e.g. a bytearray, memoryview or mmap) at the offset, and returns the number of bytes written.
+	Payloads can be given already serialized. Raises a ValueError if the payload doesn't fit."""
+	data = payload.SerializeToString() if isinstance(payload, spb.Payload) else payload
+	view = memoryview(buffer)
+	end = offset + len(data)
+	if end > len(view):
+		raise ValueError(f"A {len(data)} byte payload doesn't fit in the buffer at offset {offset}")
+	view[offset:end] = data
+	return len(data)
+
+
+class PayloadBuffer:
+	"""Collects serialized payloads back to back in a single contiguous buffer, for file sinks and batched socket writes.
+
+	Payload `i` occupies `buffer[offsets[i]:offsets[i + 1]]`. An SpbModel can write every payload it serializes straight into the buffer with:
+		payloads = PayloadBuffer()
+		model = SpbModel(metrics, serialize_cast=payloads.append)
+	in which case the get*Payload methods return the index of the payload in the buffer.
+	"""
+
+	def __init__(self) -> None:
+		self.buffer = bytearray()
+		self.offsets = array("Q", [0])
+
+	def __len__(self) -> int:
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i: int) -> bytes:
+		"""Returns a copy of payload `i`"""
+		if i < 0:
+			i += len(self)
+		if not 0 <= i < len(self):
+			raise IndexError("payload index out of range")
+		return bytes(self.buffer[self.offsets[i]:self.offsets[i + 1]])
+
+	def append(self, payload: Union[spb.Payload, bytes, bytearray, memoryview]) -> int:
+		"""Appends a payload, serializing it if needed, and returns its index"""
+		if isinstance(payload, spb.Payload):
+			payload = payload.SerializeToString()
+		self.buffer += payload
+		self.offsets.append(len(self.buffer))
+		return len(self.offsets) - 2
+
+	def view(self) -> memoryview:
+		"""Returns a view over all the payloads. The view must be released before more payloads are appended or the buffer is cleared."""
+		return memoryview(self.buffer)
+
+	def clear(self) -> None:
+		"""Discards all payloads"""
+		del self.buffer[:]
+		del self.offsets[1:]
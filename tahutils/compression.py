@@ -0,0 +1,63 @@
+import gzip
+import zlib
+from enum import Enum
+from typing import Union
+
+from tahutils.tahu import sparkplug_b as spb
+
+# Compressed payloads carry this uuid, the algorithm as a String metric, and the serialized payload in `body`
+COMPRESSED_UUID = "SPBV1.0_COMPRESSED"
+ALGORITHM_METRIC = "algorithm"
+
+class Compression(Enum):
+	"""The payload compression algorithms defined by the Sparkplug specification"""
+	DEFLATE = "DEFLATE"
+	GZIP = "GZIP"
+
+def compress(data: bytes, algorithm: Compression, level: int = -1) -> bytes:
+	"""Compresses the bytes with the given algorithm. DEFLATE output is zlib-wrapped, as produced by other Sparkplug implementations."""
+	if algorithm is Compression.DEFLATE:
+		return zlib.compress(data, level)
+	if algorithm is Compression.GZIP:
+		return gzip.compress(data, 9 if level == -1 else level)
+	raise ValueError(f"Unsupported compression algorithm {algorithm}")
+
+def decompress(data: bytes, algorithm: Union[Compression, str]) -> bytes:
+	"""Decompresses the bytes with the given algorithm"""
+	algorithm = Compression(algorithm.upper()) if isinstance(algorithm, str) else algorithm
+	if algorithm is Compression.DEFLATE:
+		return zlib.decompress(data)
+	return gzip.decompress(data)
+
+def is_compressed(payload: spb.Payload) -> bool:
+	"""Returns whether the payload is a compressed wrapper around another payload"""
+	return payload.uuid == COMPRESSED_UUID
+
+def compress_payload(payload: spb.Payload, algorithm: Compression, level: int = -1) -> spb.Payload:
+	"""Wraps the payload in a compressed payload. The wrapper keeps the payload timestamp, the sequence number is only in the compressed body."""
+	wrapper = spb.Payload()
+	if payload.HasField("timestamp"):
+		wrapper.timestamp = payload.timestamp
+	wrapper.uuid = COMPRESSED_UUID
+	wrapper.body = compress(payload.SerializeToString(), algorithm, level)
+	metric = wrapper.metrics.add()
+	metric.name = ALGORITHM_METRIC
+	metric.datatype = spb.MetricDataType.String
+	metric.string_value = algorithm.value
+	return wrapper
+
+def decompress_payload(payload: spb.Payload) -> spb.Payload:
+	"""Returns the payload wrapped by a compressed payload. Payloads that aren't compressed are returned as is."""
+	if not is_compressed(payload):
+		return payload
+	algorithm = Compression.DEFLATE
+	for metric in payload.metrics:
+		if metric.name == ALGORITHM_METRIC:
+			try:
+				algorithm = Compression(metric.string_value.upper())
+			except ValueError:
+				raise ValueError(f"Unsupported compression algorithm {metric.string_value}") from None
+			break
+	inner = spb.Payload()
+	inner.ParseFromString(decompress(payload.body, algorithm))
+	return inner
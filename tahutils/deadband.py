@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from tahutils.utils import values_equal
+
+
+@dataclass(frozen=True)
+class Deadband:
+	"""Report-by-exception settings for a single metric.
+
+	A changed value is only published when it moves more than `absolute` (in the metric's units) or more than
+	`percent` (relative to the last published value) away from the last published value. A change exceeding
+	either configured deadband is published. Without either deadband, any change is published.
+
+	Intervals are in milliseconds. A change within `min_interval` of the last publish is held back until the
+	interval has passed, and the metric is republished once `max_interval` has passed even if unchanged.
+
+	Can be configured through the `deadbands` argument of `SpbModel`, or as dataclass metadata:
+		temperature: Annotated[MetricDataType.Float, "Temperature", Deadband(absolute=0.5)]
+	"""
+	absolute: Optional[float] = None
+	percent: Optional[float] = None
+	min_interval: Optional[int] = None
+	max_interval: Optional[int] = None
+
+	def exceeded(self, value: Any, last: Any) -> bool:
+		"""Returns whether the change from the last published value is large enough to be published"""
+		if values_equal(value, last):
+			return False
+		if self.absolute is None and self.percent is None:
+			return True
+		try:
+			delta = abs(value - last)
+		except (TypeError, ValueError):
+			# Non-numeric values (or arrays of different shapes) can't be compared against a deadband, so any change counts
+			return True
+		# Array values, e.g. NumPy arrays, are compared elementwise and exceed the deadband if any element does
+		if self.absolute is not None and _any(delta > self.absolute):
+			return True
+		if self.percent is not None and _any(delta * 100 > self.percent * abs(last)):
+			return True
+		return False
+
+
+def _any(result: Any) -> bool:
+	return bool(result.any()) if hasattr(result, "any") else bool(result)
@@ -0,0 +1,318 @@
+import asyncio
+import inspect
+import logging
+from typing import Any, Awaitable, Callable, Optional, Protocol, Union
+
+from tahutils.parse import ParsedMetric, parse_payload_to_metric_list, payload_from_string
+from tahutils.router import TopicRouter
+from tahutils.spb import CommandMetric, ParsedTopic, SpbModel, SpbTopic
+from tahutils.types import MetricValues
+
+
+class Transport(Protocol):
+	"""The MQTT operations an EdgeNode publishes through. Payloads are any bytes-like object."""
+
+	async def connect(self, will_topic: str, will_payload: bytes) -> None:
+		"""Connects, registering the will to be published if the connection is lost"""
+
+	async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False) -> None:
+		"""Publishes a message"""
+
+	async def subscribe(self, pattern: str, callback: Callable[[str, bytes], Any]) -> None:
+		"""Calls the callback with the topic and payload of each message received on topics matching the filter"""
+
+	async def disconnect(self) -> None:
+		"""Disconnects cleanly, without publishing the will"""
+
+
+class MemoryTransport:
+	"""A transport that records published messages in memory, for tests. Messages can be sent to subscribers with `deliver`.
+	A `delay` in seconds can be set to simulate a slow connection."""
+
+	def __init__(self, delay: float = 0) -> None:
+		self.delay = delay
+		self.connected = False
+		self.will: Optional[tuple[str, bytes]] = None
+		self.messages: list[tuple[str, bytes]] = []
+		self._subscriptions = TopicRouter()
+
+	async def connect(self, will_topic: str, will_payload: bytes) -> None:
+		self.will = (will_topic, will_payload)
+		self.connected = True
+
+	async def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False) -> None:
+		if not self.connected:
+			raise ConnectionError("Not connected")
+		if self.delay:
+			await asyncio.sleep(self.delay)
+		self.messages.append((topic, payload))
+
+	async def subscribe(self, pattern: str, callback: Callable[[str, bytes], Any]) -> None:
+		self._subscriptions.add(pattern, callback)
+
+	async def disconnect(self) -> None:
+		self.connected = False
+
+	def deliver(self, topic: str, payload: bytes) -> int:
+		"""Calls the subscribers of the topic with the payload, and returns how many there were"""
+		return self._subscriptions.dispatch(topic, payload)
+
+
+logger = logging.getLogger(__name__)
+
+Scan = Callable[[], Union[MetricValues, Awaitable[MetricValues]]]
+
+class EdgeNode:
+	"""An asyncio runtime for an edge node and its devices, publishing through a Transport.
+
+	Births and deaths are published in order: the NDEATH is registered as the will before the NBIRTH, and device births follow
+	the node's. After starting, values are set with `update` (or by scans added with `addScan`) and are coalesced in each model
+	until the next publish cycle, which runs at most every `publish_interval` seconds and flushes only the models that changed.
+	Payloads wait in a queue of at most `max_queue` messages for the transport. When it is full, publish cycles wait for space,
+	while further updates keep coalescing in the models. A Rebirth command republishes every birth.
+
+	Errors raised by scans or while handling commands are passed to `on_error`, or logged if it isn't set, and the scans keep running. If publishing fails,
+	e.g. because the transport lost its connection, publishing stops, the error is reported the same way and kept in `failure`,
+	and `stop` raises it.
+	"""
+
+	def __init__(
+			self,
+			topic: SpbTopic,
+			model: SpbModel,
+			transport: Transport,
+			publish_interval: float = 0.1,
+			max_queue: int = 1000,
+			qos: int = 0,
+			on_command: Optional[Callable[[ParsedTopic, list[ParsedMetric]], Any]] = None,
+			on_error: Optional[Callable[[Exception], Any]] = None
+		) -> None:
+		if model.is_device:
+			raise ValueError("The edge node's model must be a node model")
+		self.topic = topic
+		self.model = model
+		self.transport = transport
+		self.publish_interval = publish_interval
+		self.qos = qos
+		self.on_command = on_command
+		self.on_error = on_error
+		self.failure: Optional[Exception] = None
+
+		self.devices: dict[str, SpbModel] = {}
+		self._device_topics: dict[str, SpbTopic] = {}
+
+		self.max_queue = max_queue
+		self._queue: Optional[asyncio.Queue] = None
+		self._dirty: set[Optional[str]] = set()
+		self._dirty_event: Optional[asyncio.Event] = None
+		self._retries: dict[Optional[str], asyncio.TimerHandle] = {}
+		self._rebirth_requested = False
+		self._scans: list[tuple[Scan, float, Optional[str]]] = []
+		self._tasks: list[asyncio.Task] = []
+		self.running = False
+
+	def addDevice(self, device_id: str, model: SpbModel) -> SpbModel:
+		"""Adds a device, whose model must be attached to the node's model. Devices must be added before starting."""
+		if self.running:
+			raise ValueError("Devices must be added before the edge node is started")
+		if model.node is not self.model:
+			raise ValueError("Device models must be created with node set to the edge node's model")
+		self.devices[device_id] = model
+		self._device_topics[device_id] = self.topic.construct_device_topic(device_id)
+		return model
+
+	def addScan(self, scan: Scan, interval: float, device_id: Optional[str] = None) -> None:
+		"""Adds a scan, called every `interval` seconds, whose returned state (or awaitable of it) is applied to the node or device with `update`"""
+		if device_id is not None and device_id not in self.devices:
+			raise ValueError(f"Unknown device {device_id}")
+		self._scans.append((scan, interval, device_id))
+		if self.running:
+			self._tasks.append(asyncio.create_task(self._scanLoop(scan, interval, device_id)))
+
+	def _model(self, device_id: Optional[str]) -> SpbModel:
+		return self.model if device_id is None else self.devices[device_id]
+
+	def update(self, state: MetricValues, device_id: Optional[str] = None) -> None:
+		"""Sets the values of the node's or device's metrics, to be published by the next publish cycle"""
+		model = self._model(device_id)
+		model.update(state)
+		if model.dirty:
+			self._dirty.add(device_id)
+			if self._dirty_event is not None:
+				self._dirty_event.set()
+
+	def requestRebirth(self) -> None:
+		"""Republishes the node and device births in the next publish cycle"""
+		self._rebirth_requested = True
+		if self._dirty_event is not None:
+			self._dirty_event.set()
+
+	async def start(self, state: MetricValues, device_states: dict[str, MetricValues]) -> None:
+		"""Connects, publishes the births with the given initial states, and starts publishing. Every device needs an initial state.
+		Raises the error publishing failed with, if it did before the births were queued."""
+		if device_states.keys() != self.devices.keys():
+			raise ValueError("An initial state is required for every device")
+		self._queue = asyncio.Queue(self.max_queue)
+		self._dirty_event = asyncio.Event()
+
+		await self.transport.connect(self.topic.ndeath, self.model.getDeathPayload())
+		await self.transport.subscribe(self.topic.ncmd, self.handleCommand)
+		await self.transport.subscribe(self.topic.construct_device_topic("+").dcmd, self.handleCommand)
+
+		# The publisher runs first, since there can be more births than fit in the queue
+		self.running = True
+		self.failure = None
+		self._tasks = [asyncio.create_task(self._publishLoop())]
+		self._tasks[0].add_done_callback(self._publisherDone)
+		# Waits on the publisher too, since publishing may fail while the queue is full
+		publisher = self._tasks[0]
+		births = asyncio.create_task(self._queueBirths(state, device_states))
+		await asyncio.wait([births, publisher], return_when=asyncio.FIRST_COMPLETED)
+		if not births.done():
+			births.cancel()
+			await asyncio.gather(births, return_exceptions=True)
+		if self.failure is not None:
+			self.running = False
+			self._tasks = []
+			raise self.failure
+		births.result()
+
+		self._tasks.append(asyncio.create_task(self._flushLoop()))
+		self._tasks.extend(asyncio.create_task(self._scanLoop(*scan)) for scan in self._scans)
+
+	async def _queueBirths(self, state: MetricValues, device_states: dict[str, MetricValues]) -> None:
+		await self._queue.put((self.topic.nbirth, self.model.getBirthPayload(state)))
+		for device_id, model in self.devices.items():
+			await self._queue.put((self._device_topics[device_id].dbirth, model.getBirthPayload(device_states[device_id])))
+
+	async def stop(self) -> None:
+		"""Publishes any pending changes, then the node's death, and disconnects. Raises the error publishing failed with, if it did."""
+		if not self.running:
+			return
+		self.running = False
+		publisher, *tasks = self._tasks
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		for retry in self._retries.values():
+			retry.cancel()
+		self._retries.clear()
+
+		# Waits on the publisher too, since publishing may fail while the queue is full
+		drained = asyncio.create_task(self._drain())
+		await asyncio.wait([drained, publisher], return_when=asyncio.FIRST_COMPLETED)
+		drained.cancel()
+		publisher.cancel()
+		await asyncio.gather(drained, publisher, return_exceptions=True)
+		self._tasks = []
+		if self.failure is not None:
+			raise self.failure
+
+		await self.transport.publish(self.topic.ndeath, self.model.last_death, self.qos)
+		await self.transport.disconnect()
+
+	async def _drain(self) -> None:
+		"""Publishes every pending change and waits for the queue to empty"""
+		# A cancelled publish cycle may have left changes unpublished, so every model is checked, and held changes are published too
+		self._dirty.update([None, *self.devices])
+		await self._flushDirty(force=True)
+		await self._queue.join()
+
+	def _reportError(self, error: Exception) -> None:
+		if self.on_error is not None:
+			self.on_error(error)
+		else:
+			logger.error("Edge node %s: %s", self.topic.edge_node_id, error, exc_info=error)
+
+	def _publisherDone(self, publisher: asyncio.Task) -> None:
+		"""Stops the publish cycles and scans if the publisher failed, since nothing more can be published"""
+		if publisher.cancelled() or publisher.exception() is None:
+			return
+		self.failure = publisher.exception()
+		self._reportError(self.failure)
+		for task in self._tasks[1:]:
+			task.cancel()
+
+	def handleCommand(self, topic: str, payload: bytes) -> None:
+		"""Handles an NCMD or DCMD. Rebirth commands are handled by the node, others are passed to `on_command`.
+		Malformed commands and errors raised by `on_command` are reported like scan errors, rather than raised to the transport."""
+		try:
+			parsed_topic = SpbTopic.parse(topic)
+			metrics = parse_payload_to_metric_list(payload_from_string(payload))
+			if parsed_topic.message_type == "NCMD" and any(m.name == CommandMetric.Rebirth.value and m.value for m in metrics):
+				self.requestRebirth()
+			elif self.on_command is not None:
+				self.on_command(parsed_topic, metrics)
+		except Exception as e:
+			self._reportError(e)
+
+	async def _publishBirths(self) -> None:
+		"""Republishes the node and device births with their last published values"""
+		self._rebirth_requested = False
+		await self._queue.put((self.topic.nbirth, self.model.getBirthPayload({}, rebirth=True)))
+		for device_id, model in self.devices.items():
+			await self._queue.put((self._device_topics[device_id].dbirth, model.getBirthPayload({}, rebirth=True)))
+
+	async def _flushDirty(self, force: bool = False) -> None:
+		"""Publishes a data payload for each changed node or device. With `force`, changes held back by a minimum interval are published too."""
+		if self._rebirth_requested:
+			await self._publishBirths()
+		dirty, self._dirty = self._dirty, set()
+		for device_id in dirty:
+			model = self._model(device_id)
+			if not model.dirty:
+				continue
+			topic = self.topic.ndata if device_id is None else self._device_topics[device_id].ddata
+			# Nothing is published, nor a sequence number used, if every change was held back or within a deadband
+			payload = model.flush(skip_empty=True, force=force)
+			if payload is not None:
+				await self._queue.put((topic, payload))
+			# Changes held back by a deadband's minimum interval are retried once it has passed
+			if model.dirty and device_id not in self._dirty:
+				self._retryAt(device_id, model.heldUntil())
+
+	def _retryAt(self, device_id: Optional[str], held_until: Optional[int]) -> None:
+		"""Marks the node or device as changed again at the given time of its model's clock"""
+		if device_id in self._retries:
+			return
+		if held_until is None:
+			self._retry(device_id)
+			return
+		delay = max(0, held_until - self._model(device_id).clock()) / 1000
+		self._retries[device_id] = asyncio.get_running_loop().call_later(delay, self._retry, device_id)
+
+	def _retry(self, device_id: Optional[str]) -> None:
+		self._retries.pop(device_id, None)
+		self._dirty.add(device_id)
+		self._dirty_event.set()
+
+	async def _flushLoop(self) -> None:
+		while True:
+			await self._dirty_event.wait()
+			self._dirty_event.clear()
+			await self._flushDirty()
+			if self._dirty:
+				self._dirty_event.set()
+			await asyncio.sleep(self.publish_interval)
+
+	async def _publishLoop(self) -> None:
+		while True:
+			topic, payload = await self._queue.get()
+			try:
+				await self.transport.publish(topic, payload, self.qos)
+			finally:
+				self._queue.task_done()
+
+	async def _scanLoop(self, scan: Scan, interval: float, device_id: Optional[str]) -> None:
+		loop = asyncio.get_running_loop()
+		deadline = loop.time()
+		while True:
+			try:
+				state = scan()
+				if inspect.isawaitable(state):
+					state = await state
+				self.update(state, device_id)
+			except Exception as e:
+				self._reportError(e)
+			deadline += interval
+			await asyncio.sleep(max(0, deadline - loop.time()))
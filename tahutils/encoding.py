@@ -0,0 +1,109 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from tahutils.tahu import array_packer as ap
+from tahutils.tahu import sparkplug_b as spb
+
+
+def _signed(bits: int) -> Callable[[int], int]:
+	"""Returns a function that wraps negative values into the unsigned range used on the wire"""
+	offset = 1 << bits
+	def wrap(value: int) -> int:
+		return value + offset if value < 0 else value
+	return wrap
+
+_mdt = spb.MetricDataType
+
+# Maps each metric datatype to the Metric value field and an optional conversion applied before assignment
+VALUE_FIELDS: dict[int, tuple[str, Optional[Callable[[Any], Any]]]] = {
+	_mdt.Int8: ("int_value", _signed(8)),
+	_mdt.Int16: ("int_value", _signed(16)),
+	_mdt.Int32: ("int_value", _signed(32)),
+	_mdt.Int64: ("long_value", _signed(64)),
+	_mdt.UInt8: ("int_value", None),
+	_mdt.UInt16: ("int_value", None),
+	_mdt.UInt32: ("int_value", None),
+	_mdt.UInt64: ("long_value", None),
+	_mdt.Float: ("float_value", None),
+	_mdt.Double: ("double_value", None),
+	_mdt.Boolean: ("boolean_value", None),
+	_mdt.String: ("string_value", None),
+	_mdt.DateTime: ("long_value", None),
+	_mdt.Text: ("string_value", None),
+	_mdt.UUID: ("string_value", None),
+	_mdt.DataSet: ("dataset_value", None),
+	_mdt.Bytes: ("bytes_value", None),
+	_mdt.File: ("bytes_value", None),
+	_mdt.Template: ("template_value", None),
+	_mdt.Int8Array: ("bytes_value", ap.convert_to_packed_int8_array),
+	_mdt.Int16Array: ("bytes_value", ap.convert_to_packed_int16_array),
+	_mdt.Int32Array: ("bytes_value", ap.convert_to_packed_int32_array),
+	_mdt.Int64Array: ("bytes_value", ap.convert_to_packed_int64_array),
+	_mdt.UInt8Array: ("bytes_value", ap.convert_to_packed_uint8_array),
+	_mdt.UInt16Array: ("bytes_value", ap.convert_to_packed_uint16_array),
+	_mdt.UInt32Array: ("bytes_value", ap.convert_to_packed_uint32_array),
+	_mdt.UInt64Array: ("bytes_value", ap.convert_to_packed_uint64_array),
+	_mdt.FloatArray: ("bytes_value", ap.convert_to_packed_float_array),
+	_mdt.DoubleArray: ("bytes_value", ap.convert_to_packed_double_array),
+	_mdt.BooleanArray: ("bytes_value", ap.convert_to_packed_boolean_array),
+	_mdt.StringArray: ("bytes_value", ap.convert_to_packed_string_array),
+	_mdt.DateTimeArray: ("bytes_value", ap.convert_to_packed_datetime_array),
+}
+
+# Value fields holding sub-messages, which must be copied rather than assigned
+MESSAGE_FIELDS = {"dataset_value", "template_value"}
+
+
+@dataclass(frozen=True, slots=True)
+class MetricEncoder:
+	"""Precompiled instructions for adding a single metric to a payload, replacing the datatype dispatch in `sparkplug_b.addMetric`"""
+	name: Optional[str]
+	alias: Optional[int]
+	datatype: int
+	field: str
+	convert: Optional[Callable[[Any], Any]] = None
+	is_message: bool = False
+
+	def declare(self, container):
+		"""Adds the metric to the container with only its name, alias and datatype set, and returns it"""
+		metric = container.metrics.add()
+		if self.name is not None:
+			metric.name = self.name
+		if self.alias is not None:
+			metric.alias = self.alias
+		metric.datatype = self.datatype
+		return metric
+
+	def encode(self, container, value: Any, timestamp: Optional[int] = None):
+		"""Adds the metric with the given value to the container (a payload or template) and returns it. A value of `None` is sent as a null metric."""
+		return self.fill(self.declare(container), value, timestamp)
+
+	def fill(self, metric, value: Any, timestamp: Optional[int] = None):
+		"""Sets the value and timestamp of a declared metric and returns it"""
+		if timestamp is not None:
+			metric.timestamp = timestamp
+
+		if value is None:
+			metric.is_null = True
+		elif self.is_message:
+			getattr(metric, self.field).CopyFrom(value)
+		elif self.convert is None:
+			setattr(metric, self.field, value)
+		else:
+			setattr(metric, self.field, self.convert(value))
+		return metric
+
+
+def compile_encoder(name: Optional[str], alias: Optional[int], datatype: int) -> MetricEncoder:
+	"""Compiles a MetricEncoder for the given metric. Raises a ValueError if the datatype cannot be encoded."""
+	if datatype not in VALUE_FIELDS:
+		raise ValueError(f"Unsupported metric data type {datatype} for metric {name}")
+	field, convert = VALUE_FIELDS[datatype]
+	return MetricEncoder(
+		name=name,
+		alias=alias,
+		datatype=datatype,
+		field=field,
+		convert=convert,
+		is_message=field in MESSAGE_FIELDS
+	)
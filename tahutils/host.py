@@ -0,0 +1,171 @@
+from enum import Enum
+from typing import Any, Optional, Union
+
+from tahutils.parse import ParsedMetric, parse_metric_value, payload_from_string
+from tahutils.spb import SpbTopic
+from tahutils.tahu import sparkplug_b as spb
+from tahutils.types import MetricName
+
+
+class SpbHostSession:
+	"""The last known state of a single edge node or device, as seen by a host application"""
+
+	def __init__(self, device_id: Optional[str] = None) -> None:
+		self.device_id = device_id
+		self.online = False
+		self.current_values: dict[str, Any] = {}
+		self.timestamps: dict[str, int] = {}
+		self.datatypes: dict[str, int] = {}
+		self._alias_to_metric: dict[int, tuple[str, int]] = {}
+
+	def reset(self) -> None:
+		"""Clears all metrics and aliases, ahead of a new birth"""
+		self.current_values.clear()
+		self.timestamps.clear()
+		self.datatypes.clear()
+		self._alias_to_metric.clear()
+
+	def aliasToMetric(self, alias: int) -> str:
+		"""Returns the metric name for the given alias. Raises a KeyError if the alias was not declared in the last birth."""
+		return self._alias_to_metric[alias][0]
+
+
+class SpbHostModel:
+	"""Host-side counterpart to SpbModel. Tracks the metrics, aliases and last known values of one edge node and its devices
+	from the payloads it publishes, so that aliased data payloads can be resolved to metric names."""
+
+	def __init__(self, topic: Optional[SpbTopic] = None, as_view: bool = False) -> None:
+		self.topic = topic
+		self.as_view = as_view
+
+		self.node = SpbHostSession()
+		self.devices: dict[str, SpbHostSession] = {}
+
+		self.bd_seq: Optional[int] = None
+		self.seq: Optional[int] = None
+		self.seq_errors = 0
+
+	@property
+	def online(self) -> bool:
+		"""Returns whether the node is online"""
+		return self.node.online
+
+	def session(self, device_id: Optional[str] = None) -> SpbHostSession:
+		"""Returns the session for the given device, or the node if `None`. Raises a KeyError for devices that have never been born."""
+		return self.node if device_id is None else self.devices[device_id]
+
+	def get(self, metric: MetricName, device_id: Optional[str] = None) -> Any:
+		"""Returns the last known value of the metric on the node or the given device"""
+		if isinstance(metric, Enum):
+			metric = metric.value
+		session = self.node if device_id is None else self.devices.get(device_id)
+		return session.current_values.get(metric, None) if session is not None else None
+
+	def _checkSeq(self, payload: spb.Payload) -> None:
+		"""Tracks the payload sequence number, counting any gaps"""
+		if not payload.HasField("seq"):
+			return
+		if self.seq is not None and payload.seq != (self.seq + 1) % 256:
+			self.seq_errors += 1
+		self.seq = payload.seq
+
+	def _parseMetric(self, session: SpbHostSession, metric) -> ParsedMetric:
+		"""Resolves the metric's name and datatype through the session's aliases, and decodes its value"""
+		if metric.name:
+			name = metric.name
+			datatype = metric.datatype or session.datatypes.get(name, 0)
+		elif metric.HasField("alias") and metric.alias in session._alias_to_metric:
+			name, datatype = session._alias_to_metric[metric.alias]
+		else:
+			raise ValueError(f"Unknown alias {metric.alias} on device {session.device_id}, a rebirth is required")
+		return ParsedMetric(
+			name=name,
+			value=parse_metric_value(metric, self.as_view, datatype),
+			timestamp=metric.timestamp,
+			datatype=datatype
+		)
+
+	def ingestBirth(self, payload: Union[bytes, spb.Payload], device_id: Optional[str] = None) -> list[ParsedMetric]:
+		"""Applies an NBIRTH (or a DBIRTH if device_id is set), replacing the known metrics, aliases and values. Returns the parsed metrics."""
+		if not isinstance(payload, spb.Payload):
+			payload = payload_from_string(payload)
+
+		if device_id is None:
+			session = self.node
+			self.seq = None
+			for device in self.devices.values():
+				device.online = False
+		else:
+			session = self.devices.setdefault(device_id, SpbHostSession(device_id))
+		self._checkSeq(payload)
+
+		session.reset()
+		parsed = []
+		for metric in payload.metrics:
+			if device_id is None and metric.name == "bdSeq":
+				self.bd_seq = metric.long_value
+				continue
+			if metric.HasField("alias"):
+				session._alias_to_metric[metric.alias] = (metric.name, metric.datatype)
+			p = self._parseMetric(session, metric)
+			session.datatypes[p.name] = p.datatype
+			session.current_values[p.name] = p.value
+			session.timestamps[p.name] = p.timestamp
+			parsed.append(p)
+		session.online = True
+		return parsed
+
+	def ingestData(self, payload: Union[bytes, spb.Payload], device_id: Optional[str] = None) -> list[ParsedMetric]:
+		"""Applies an NDATA (or a DDATA if device_id is set) to the last known values. Returns the parsed metrics, with aliases resolved to names.
+		Raises a ValueError if the payload uses aliases that were not declared in the last birth."""
+		if not isinstance(payload, spb.Payload):
+			payload = payload_from_string(payload)
+		session = self.node if device_id is None else self.devices.get(device_id)
+		if session is None:
+			raise ValueError(f"Data received for unknown device {device_id}, a rebirth is required")
+		self._checkSeq(payload)
+
+		parsed = [self._parseMetric(session, metric) for metric in payload.metrics]
+		current_values, timestamps = session.current_values, session.timestamps
+		for p in parsed:
+			current_values[p.name] = p.value
+			timestamps[p.name] = p.timestamp
+		return parsed
+
+	def ingestDeath(self, payload: Union[bytes, spb.Payload], device_id: Optional[str] = None) -> bool:
+		"""Applies an NDEATH (or a DDEATH if device_id is set). A node death whose bdSeq doesn't match the last birth is stale and ignored.
+		Returns whether the death was applied. Last known values are kept."""
+		if not isinstance(payload, spb.Payload):
+			payload = payload_from_string(payload)
+
+		if device_id is not None:
+			session = self.devices.get(device_id)
+			if session is None:
+				return False
+			self._checkSeq(payload)
+			session.online = False
+			return True
+
+		for metric in payload.metrics:
+			if metric.name == "bdSeq" and self.bd_seq is not None and metric.long_value != self.bd_seq:
+				return False
+		self.node.online = False
+		for device in self.devices.values():
+			device.online = False
+		return True
+
+	def ingest(self, message_type: str, payload: Union[bytes, spb.Payload], device_id: Optional[str] = None) -> list[ParsedMetric]:
+		"""Applies a payload of the given Sparkplug message type (e.g. "DDATA"). Returns the parsed metrics, which is empty for deaths and commands."""
+		message_type = message_type.upper()
+		if message_type in ("NBIRTH", "DBIRTH"):
+			return self.ingestBirth(payload, device_id)
+		if message_type in ("NDATA", "DDATA"):
+			return self.ingestData(payload, device_id)
+		if message_type in ("NDEATH", "DDEATH"):
+			self.ingestDeath(payload, device_id)
+		return []
+
+	def ingestMessage(self, topic: str, payload: Union[bytes, spb.Payload]) -> list[ParsedMetric]:
+		"""Applies a payload received on the given Sparkplug topic, as `ingest`. Raises a ValueError if the topic isn't a Sparkplug topic."""
+		parsed = SpbTopic.parse(topic)
+		return self.ingest(parsed.message_type, payload, parsed.device_id)
@@ -0,0 +1,173 @@
+import threading
+from bisect import bisect_left
+from typing import Any, Callable, Optional
+
+# Upper bounds in seconds of the latency histogram buckets, from 10us to 1s
+DEFAULT_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+	"""A latency histogram with fixed bucket upper bounds, plus an overflow bucket"""
+
+	def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value: float) -> None:
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def snapshot(self) -> dict[str, Any]:
+		"""Returns the count, sum, and the count in each bucket keyed by its upper bound"""
+		return {
+			"count": self.count,
+			"sum": self.sum,
+			"buckets": dict(zip([*self.buckets, float("inf")], self.counts)),
+		}
+
+
+Callback = Callable[[str, dict[str, Any]], Any]
+
+class Instrumentation:
+	"""Counters and latency histograms for the payloads encoded by SpbModels and decoded by the parse module.
+
+	Encoded payloads, metrics and bytes are counted per message type (e.g. "DDATA"), as are encode latencies, which cover building
+	the payload from the state through to serialization. Metrics given in a state but not published, because they were unchanged or
+	within a deadband, are counted as suppressed. Decoded payloads, metrics and bytes, and decode latencies, cover parsing serialized
+	payloads in `parse.payload_from_string`. Decoding metric values is timed separately per parse function, as "parse_payload_to_metric_list"
+	(also used by `parse_payload_to_metric_dict`), "parse_payloads_to_columns" (the whole call, including parsing any serialized
+	payloads) and "LazyPayload" (each metric decoded on access), whether the payloads were given serialized or already parsed.
+
+	Enable by passing an instance as the `instrumentation` of an SpbModel, and to `parse.set_instrumentation`. When no instance is set,
+	the only cost is a check per payload. Callbacks are called with the event ("encode", "decode" or "values") and its values after each payload or parse call.
+	"""
+
+	def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS, callbacks: Optional[list[Callback]] = None) -> None:
+		self.buckets = tuple(buckets)
+		self.callbacks: list[Callback] = list(callbacks or [])
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self) -> None:
+		"""Zeroes every counter and histogram"""
+		with self._lock:
+			self.encoded_payloads: dict[str, int] = {}
+			self.encoded_metrics: dict[str, int] = {}
+			self.encoded_bytes: dict[str, int] = {}
+			self.encode_seconds: dict[str, Histogram] = {}
+			self.suppressed_metrics = 0
+			self.decoded_payloads = 0
+			self.decoded_metrics = 0
+			self.decoded_bytes = 0
+			self.decode_seconds = Histogram(self.buckets)
+			self.value_decodes: dict[str, int] = {}
+			self.value_decoded_metrics: dict[str, int] = {}
+			self.value_decode_seconds: dict[str, Histogram] = {}
+
+	def addCallback(self, callback: Callback) -> None:
+		self.callbacks.append(callback)
+
+	def recordEncode(self, message_type: str, metrics: int, size: int, seconds: float, suppressed: int = 0) -> None:
+		"""Records an encoded payload"""
+		with self._lock:
+			self.encoded_payloads[message_type] = self.encoded_payloads.get(message_type, 0) + 1
+			self.encoded_metrics[message_type] = self.encoded_metrics.get(message_type, 0) + metrics
+			self.encoded_bytes[message_type] = self.encoded_bytes.get(message_type, 0) + size
+			histogram = self.encode_seconds.get(message_type)
+			if histogram is None:
+				histogram = self.encode_seconds[message_type] = Histogram(self.buckets)
+			histogram.observe(seconds)
+			self.suppressed_metrics += suppressed
+		for callback in self.callbacks:
+			callback("encode", {"message_type": message_type, "metrics": metrics, "bytes": size, "seconds": seconds, "suppressed": suppressed})
+
+	def recordDecode(self, metrics: int, size: int, seconds: float) -> None:
+		"""Records a decoded payload"""
+		with self._lock:
+			self.decoded_payloads += 1
+			self.decoded_metrics += metrics
+			self.decoded_bytes += size
+			self.decode_seconds.observe(seconds)
+		for callback in self.callbacks:
+			callback("decode", {"metrics": metrics, "bytes": size, "seconds": seconds})
+
+	def recordValues(self, function: str, metrics: int, seconds: float) -> None:
+		"""Records a call of a parse function that decoded metric values"""
+		with self._lock:
+			self.value_decodes[function] = self.value_decodes.get(function, 0) + 1
+			self.value_decoded_metrics[function] = self.value_decoded_metrics.get(function, 0) + metrics
+			histogram = self.value_decode_seconds.get(function)
+			if histogram is None:
+				histogram = self.value_decode_seconds[function] = Histogram(self.buckets)
+			histogram.observe(seconds)
+		for callback in self.callbacks:
+			callback("values", {"function": function, "metrics": metrics, "seconds": seconds})
+
+	def snapshot(self) -> dict[str, Any]:
+		"""Returns a copy of every counter and histogram as plain dicts"""
+		with self._lock:
+			return {
+				"encoded_payloads": dict(self.encoded_payloads),
+				"encoded_metrics": dict(self.encoded_metrics),
+				"encoded_bytes": dict(self.encoded_bytes),
+				"encode_seconds": {message_type: h.snapshot() for message_type, h in self.encode_seconds.items()},
+				"suppressed_metrics": self.suppressed_metrics,
+				"decoded_payloads": self.decoded_payloads,
+				"decoded_metrics": self.decoded_metrics,
+				"decoded_bytes": self.decoded_bytes,
+				"decode_seconds": self.decode_seconds.snapshot(),
+				"value_decodes": dict(self.value_decodes),
+				"value_decoded_metrics": dict(self.value_decoded_metrics),
+				"value_decode_seconds": {function: h.snapshot() for function, h in self.value_decode_seconds.items()},
+			}
+
+	def prometheus(self, prefix: str = "tahutils") -> str:
+		"""Returns the counters and histograms in the Prometheus text exposition format"""
+		snapshot = self.snapshot()
+		lines = []
+
+		def counter(name: str, help: str, values: dict[str, int]) -> None:
+			lines.append(f"# HELP {prefix}_{name} {help}")
+			lines.append(f"# TYPE {prefix}_{name} counter")
+			for labels, value in values.items():
+				lines.append(f"{prefix}_{name}{labels} {value}")
+
+		def histogram(name: str, help: str, values: dict[Optional[str], dict[str, Any]], label: str = "message_type") -> None:
+			lines.append(f"# HELP {prefix}_{name} {help}")
+			lines.append(f"# TYPE {prefix}_{name} histogram")
+			for labels, h in values.items():
+				cumulative = 0
+				for bound, count in h["buckets"].items():
+					cumulative += count
+					le = "+Inf" if bound == float("inf") else repr(bound)
+					lines.append(f"{prefix}_{name}_bucket{_labels(labels, label, le=le)} {cumulative}")
+				lines.append(f"{prefix}_{name}_sum{_labels(labels, label)} {h['sum']}")
+				lines.append(f"{prefix}_{name}_count{_labels(labels, label)} {h['count']}")
+
+		by_type = lambda values: {_labels(message_type): v for message_type, v in values.items()}
+		counter("encoded_payloads_total", "Payloads encoded, by message type.", by_type(snapshot["encoded_payloads"]))
+		counter("encoded_metrics_total", "Metrics encoded, by message type.", by_type(snapshot["encoded_metrics"]))
+		counter("encoded_bytes_total", "Serialized bytes encoded, by message type.", by_type(snapshot["encoded_bytes"]))
+		histogram("encode_seconds", "Time to build and serialize a payload, by message type.", snapshot["encode_seconds"])
+		counter("suppressed_metrics_total", "Metrics not published because they were unchanged or within a deadband.", {"": snapshot["suppressed_metrics"]})
+		counter("decoded_payloads_total", "Serialized payloads parsed.", {"": snapshot["decoded_payloads"]})
+		counter("decoded_metrics_total", "Metrics in the serialized payloads parsed.", {"": snapshot["decoded_metrics"]})
+		counter("decoded_bytes_total", "Serialized bytes parsed.", {"": snapshot["decoded_bytes"]})
+		histogram("decode_seconds", "Time to parse a serialized payload, excluding metric value decoding.", {None: snapshot["decode_seconds"]})
+		by_function = lambda values: {_labels(function, "function"): v for function, v in values.items()}
+		counter("value_decodes_total", "Calls decoding metric values, by parse function.", by_function(snapshot["value_decodes"]))
+		counter("value_decoded_metrics_total", "Metric values decoded, by parse function.", by_function(snapshot["value_decoded_metrics"]))
+		histogram("value_decode_seconds", "Time to decode metric values per call, by parse function.", snapshot["value_decode_seconds"], "function")
+		return "\n".join(lines) + "\n"
+
+
+def _labels(value: Optional[str], label: str = "message_type", **extra: str) -> str:
+	"""Formats the value of the label (the message type by default) and any extra labels as a Prometheus label set"""
+	labels = {label: value} if value is not None else {}
+	labels.update(extra)
+	if not labels:
+		return ""
+	return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
@@ -1,6 +1,15 @@
 from dataclasses import dataclass
 from tahutils.tahu import sparkplug_b as spb
-from typing import Any
+from tahutils.tahu import array_packer as ap
+from array import array
+from enum import Enum
+from itertools import repeat
+from time import perf_counter
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+
+from tahutils.compression import decompress_payload
+from tahutils.instrumentation import Instrumentation
+from tahutils.types import MetricName
 
 @dataclass
 class ParsedMetric:
@@ -14,85 +23,342 @@ class ParsedMetric:
 		return self.value is None
 
 
+@dataclass
+class ParsedTemplate:
+	version: str
+	template_ref: str
+	is_definition: bool
+	metrics: list[ParsedMetric]
+	parameters: dict[str, Any]
+
+
+_instrumentation: Optional[Instrumentation] = None
+
+def set_instrumentation(instrumentation: Optional[Instrumentation]) -> None:
+	"""Sets the Instrumentation recording the payloads parsed by `payload_from_string` and the metric values decoded by the parse
+	functions, or disables it with `None`"""
+	global _instrumentation
+	_instrumentation = instrumentation
+
+
 def payload_from_string(s):
-	"""Constructs a payload and executes its ParseFromString method on the input"""
+	"""Constructs a payload and executes its ParseFromString method on the input, which can be any bytes-like object.
+	Compressed payloads are decompressed transparently."""
+	instrumentation = _instrumentation
+	if instrumentation is not None:
+		started = perf_counter()
+	if not isinstance(s, bytes):
+		s = bytes(s)
 	p = spb.Payload()
 	p.ParseFromString(s)
+	p = decompress_payload(p)
+	if instrumentation is not None:
+		instrumentation.recordDecode(len(p.metrics), len(s), perf_counter() - started)
 	return p
 
 
-def parse_payload_to_metric_list(payload: spb.Payload) -> list[ParsedMetric]:
-	"""Parses the payload to a list of ParsedMetric"""
+def parse_payload_to_metric_list(payload: spb.Payload, as_view: bool = False) -> list[ParsedMetric]:
+	"""Parses the payload to a list of ParsedMetric. With `as_view`, array values are returned as views over the packed bytes."""
+	instrumentation = _instrumentation
+	if instrumentation is not None:
+		started = perf_counter()
 	parsed = [
 		ParsedMetric(
 			name=metric.name,
-			value=parse_metric_value(metric),
+			value=parse_metric_value(metric, as_view),
 			timestamp=metric.timestamp,
 			datatype=metric.datatype
 		)
 		for metric in payload.metrics
 	]
+	if instrumentation is not None:
+		instrumentation.recordValues("parse_payload_to_metric_list", len(parsed), perf_counter() - started)
 	return parsed
 
 
-def parse_payload_to_metric_dict(payload: spb.Payload) -> dict[str, ParsedMetric]:
+def parse_payload_to_metric_dict(payload: spb.Payload, as_view: bool = False) -> dict[str, ParsedMetric]:
 	"""Parses the payload to a dict of MetricName -> ParsedMetric"""
-	return {metric.name: metric for metric in parse_payload_to_metric_list(payload)}
+	return {metric.name: metric for metric in parse_payload_to_metric_list(payload, as_view)}
+
+
+@dataclass
+class MetricColumns:
+	"""Metrics from many payloads as parallel columns, with one row per metric. Numeric columns are NumPy arrays if NumPy is
+	installed, otherwise `array.array`s. Each value is stored in the column for its kind, with zero/NaN/None in the others."""
+	payload_index: Any
+	names: list[str]
+	aliases: Any
+	timestamps: Any
+	datatypes: Any
+	is_null: Any
+	int_values: Any
+	float_values: Any
+	other_values: list[Any]
+
+	def __len__(self) -> int:
+		return len(self.names)
+
+
+def _column(values: array, dtype: Optional[str] = None) -> Any:
+	"""Wraps the array as a NumPy array without copying, if NumPy is available"""
+	if ap.np is None:
+		return values
+	return ap.np.frombuffer(values, dtype=dtype or values.typecode)
+
+
+def parse_payloads_to_columns(payloads: Iterable[Union[bytes, spb.Payload]], as_view: bool = False) -> MetricColumns:
+	"""Decodes many payloads into columns without creating a ParsedMetric per value.
+	Integer, boolean and datetime values go in `int_values` (int64, UInt64 values wrap to their two's complement), float and double
+	values in `float_values` (float64), and all other values in `other_values`. Metrics without an alias have an alias of -1."""
+	instrumentation = _instrumentation
+	if instrumentation is not None:
+		started = perf_counter()
+	payload_index, aliases, timestamps = array("q"), array("q"), array("q")
+	datatypes, is_null = array("B"), array("B")
+	int_values, float_values = array("q"), array("d")
+	names, other_values = [], []
+
+	nan = float("nan")
+	int_decoders, float_decoders = _INT_COLUMN_DECODERS, _FLOAT_COLUMN_DECODERS
+	# Bound appends, as appending to every column for every metric dominates the cost
+	add_name, add_alias, add_timestamp, add_datatype = names.append, aliases.append, timestamps.append, datatypes.append
+	add_null, add_int, add_float, add_other = is_null.append, int_values.append, float_values.append, other_values.append
+	for i, payload in enumerate(payloads):
+		if not isinstance(payload, spb.Payload):
+			payload = payload_from_string(payload)
+		metrics = payload.metrics
+		payload_index.extend(repeat(i, len(metrics)))
+		for m in metrics:
+			dtype = m.datatype
+			add_name(m.name)
+			add_alias(m.alias if m.HasField("alias") else -1)
+			add_timestamp(m.timestamp)
+			add_datatype(dtype)
+
+			if m.is_null:
+				add_null(1)
+				add_int(0)
+				add_float(nan)
+				add_other(None)
+				continue
+			add_null(0)
+
+			if dtype in int_decoders:
+				add_int(int_decoders[dtype](m))
+				add_float(nan)
+				add_other(None)
+			elif dtype in float_decoders:
+				add_int(0)
+				add_float(float_decoders[dtype](m))
+				add_other(None)
+			else:
+				add_int(0)
+				add_float(nan)
+				add_other(parse_metric_value(m, as_view))
+
+	if instrumentation is not None:
+		instrumentation.recordValues("parse_payloads_to_columns", len(names), perf_counter() - started)
+	return MetricColumns(
+		payload_index=_column(payload_index),
+		names=names,
+		aliases=_column(aliases),
+		timestamps=_column(timestamps),
+		datatypes=_column(datatypes),
+		is_null=_column(is_null, "bool"),
+		int_values=_column(int_values),
+		float_values=_column(float_values),
+		other_values=other_values
+	)
+
+
+class LazyPayload:
+	"""A read-only view of a payload that only decodes the metrics that are accessed. Metrics are looked up by name or alias,
+	through an index built on the first lookup. If a metric appears more than once, lookups return its last occurrence."""
+
+	def __init__(self, payload: Union[bytes, spb.Payload], as_view: bool = False) -> None:
+		if not isinstance(payload, spb.Payload):
+			payload = payload_from_string(payload)
+		self.payload = payload
+		self.as_view = as_view
+		self._metrics = payload.metrics
+		self._index: Optional[dict[Union[str, int], int]] = None
+		self._parsed: dict[int, ParsedMetric] = {}
+
+	def _buildIndex(self) -> dict[Union[str, int], int]:
+		index = {}
+		for i, metric in enumerate(self._metrics):
+			if metric.name:
+				index[metric.name] = i
+			if metric.HasField("alias"):
+				index[metric.alias] = i
+		self._index = index
+		return index
+
+	def at(self, i: int) -> ParsedMetric:
+		"""Returns the metric at the given position in the payload"""
+		parsed = self._parsed.get(i)
+		if parsed is None:
+			instrumentation = _instrumentation
+			if instrumentation is not None:
+				started = perf_counter()
+			metric = self._metrics[i]
+			parsed = self._parsed[i] = ParsedMetric(
+				name=metric.name,
+				value=parse_metric_value(metric, self.as_view),
+				timestamp=metric.timestamp,
+				datatype=metric.datatype
+			)
+			if instrumentation is not None:
+				instrumentation.recordValues("LazyPayload", 1, perf_counter() - started)
+		return parsed
+
+	def __getitem__(self, key: Union[MetricName, int]) -> ParsedMetric:
+		"""Returns the metric with the given name or alias. Raises a KeyError if there is none."""
+		if isinstance(key, Enum):
+			key = key.value
+		index = self._index if self._index is not None else self._buildIndex()
+		return self.at(index[key])
+
+	def get(self, key: Union[MetricName, int], default: Any = None) -> Any:
+		"""Returns the metric with the given name or alias, or the default if there is none"""
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __contains__(self, key: Union[MetricName, int]) -> bool:
+		if isinstance(key, Enum):
+			key = key.value
+		index = self._index if self._index is not None else self._buildIndex()
+		return key in index
+
+	def __len__(self) -> int:
+		return len(self._metrics)
+
+	def __iter__(self) -> Iterator[ParsedMetric]:
+		"""Iterates over every metric in payload order, decoding each as it is reached"""
+		for i in range(len(self._metrics)):
+			yield self.at(i)
+
+
+def _signed(bits: int) -> Callable[[int], int]:
+	"""Returns a function that converts a value from its unsigned wire representation back to a signed integer.
+	Values sign-extended to a wider field, as some implementations send them, are masked to the bit width first."""
+	limit = 1 << (bits - 1)
+	offset = 1 << bits
+	mask = offset - 1
+	def unwrap(value: int) -> int:
+		value &= mask
+		return value - offset if value >= limit else value
+	return unwrap
+
+_int8, _int16, _int32, _int64 = _signed(8), _signed(16), _signed(32), _signed(64)
+
+def _scalar(decode: Callable[[Any], Any]) -> Callable[[Any, bool], Any]:
+	return lambda m, as_view: decode(m)
+
+def _array(unpack: Callable) -> Callable[[Any, bool], Any]:
+	return lambda m, as_view: unpack(m.bytes_value, as_view)
+
+_dsdt = spb.DataSetDataType
+
+# Decoders for the basic types shared by dataset values and template parameters
+_BASIC_DECODERS: dict[int, Callable[[Any], Any]] = {
+	_dsdt.Int8: lambda m: _int8(m.int_value),
+	_dsdt.Int16: lambda m: _int16(m.int_value),
+	_dsdt.Int32: lambda m: _int32(m.int_value),
+	_dsdt.Int64: lambda m: _int64(m.long_value),
+	_dsdt.UInt8: lambda m: m.int_value,
+	_dsdt.UInt16: lambda m: m.int_value,
+	_dsdt.UInt32: lambda m: m.int_value,
+	_dsdt.UInt64: lambda m: m.long_value,
+	_dsdt.Float: lambda m: m.float_value,
+	_dsdt.Double: lambda m: m.double_value,
+	_dsdt.Boolean: lambda m: m.boolean_value,
+	_dsdt.String: lambda m: m.string_value,
+	_dsdt.DateTime: lambda m: m.long_value,
+	_dsdt.Text: lambda m: m.string_value,
+}
 
 
 def parse_dataset_value(m, dtype: int):
-	dsdt = spb.DataSetDataType
-
-	val = None
-	if dsdt.Int8 <= dtype <= dsdt.Int32 or dsdt.UInt8 <= dtype <= dsdt.UInt32:
-		val = m.int_value
-	elif dtype in [dsdt.Int64, dsdt.UInt64]:
-		val = m.long_value
-	elif dtype == dsdt.Float:
-		val = m.float_value
-	elif dtype == dsdt.Double:
-		val = m.double_value
-	elif dtype == dsdt.Boolean:
-		val = m.boolean_value
-	elif dtype == dsdt.String:
-		val = m.string_value
-	elif dtype == dsdt.DateTime:
-		val = m.long_value
-	else:
-		raise NotImplementedError("Unhandled dataset data type %d", dtype)
-	return val
-
-
-def parse_metric_value(m):
-	mdt = spb.MetricDataType
-
-	val = None
-	dtype = m.datatype 
-	if m.is_null:
-		val = None
-	elif mdt.Int8 <= dtype <= mdt.Int32 or mdt.UInt8 <= dtype <= mdt.UInt32:
-		val = m.int_value
-	elif dtype in [mdt.Int64, mdt.UInt64]:
-		val = m.long_value
-	elif dtype == mdt.Float:
-		val = m.float_value
-	elif dtype == mdt.Double:
-		val = m.double_value
-	elif dtype == mdt.Boolean:
-		val = m.boolean_value
-	elif dtype == mdt.String:
-		val = m.string_value
-	elif dtype == mdt.DateTime:
-		val = m.long_value
-	elif dtype == mdt.DataSet:
-		d = m.dataset_value
-		val = [
-			[
-				parse_dataset_value(element, t) 
-				for element, t in zip(row.elements, d.types)
-			]
-			for row in d.rows
+	decoder = _BASIC_DECODERS.get(dtype)
+	if decoder is None:
+		raise NotImplementedError(f"Unhandled dataset data type {dtype}")
+	return decoder(m)
+
+
+def _parse_dataset(m, as_view: bool):
+	d = m.dataset_value
+	return [
+		[
+			parse_dataset_value(element, t) 
+			for element, t in zip(row.elements, d.types)
 		]
-	else:
-		raise NotImplementedError("Unhandled metric data type %d", dtype)
-	return val
\ No newline at end of file
+		for row in d.rows
+	]
+
+
+def _parse_template(m, as_view: bool) -> ParsedTemplate:
+	t = m.template_value
+	return ParsedTemplate(
+		version=t.version,
+		template_ref=t.template_ref,
+		is_definition=t.is_definition,
+		metrics=parse_payload_to_metric_list(t, as_view),
+		parameters={p.name: parse_dataset_value(p, p.type) for p in t.parameters}
+	)
+
+_mdt = spb.MetricDataType
+
+# Decoders for each metric data type, taking the metric and whether array values should be returned as views
+_METRIC_DECODERS: dict[int, Callable[[Any, bool], Any]] = {
+	**{dtype: _scalar(decode) for dtype, decode in _BASIC_DECODERS.items()},
+	_mdt.UUID: lambda m, as_view: m.string_value,
+	_mdt.DataSet: _parse_dataset,
+	_mdt.Bytes: lambda m, as_view: m.bytes_value,
+	_mdt.File: lambda m, as_view: m.bytes_value,
+	_mdt.Template: _parse_template,
+	_mdt.Int8Array: _array(ap.convert_from_packed_int8_array),
+	_mdt.Int16Array: _array(ap.convert_from_packed_int16_array),
+	_mdt.Int32Array: _array(ap.convert_from_packed_int32_array),
+	_mdt.Int64Array: _array(ap.convert_from_packed_int64_array),
+	_mdt.UInt8Array: _array(ap.convert_from_packed_uint8_array),
+	_mdt.UInt16Array: _array(ap.convert_from_packed_uint16_array),
+	_mdt.UInt32Array: _array(ap.convert_from_packed_uint32_array),
+	_mdt.UInt64Array: _array(ap.convert_from_packed_uint64_array),
+	_mdt.FloatArray: _array(ap.convert_from_packed_float_array),
+	_mdt.DoubleArray: _array(ap.convert_from_packed_double_array),
+	_mdt.BooleanArray: _array(ap.convert_from_packed_boolean_array),
+	_mdt.StringArray: lambda m, as_view: ap.convert_from_packed_string_array(m.bytes_value),
+	_mdt.DateTimeArray: _array(ap.convert_from_packed_datetime_array),
+}
+
+
+_uint64 = _signed(64)
+
+# Decoders for the metric types stored in the int64 and float64 columns of MetricColumns
+_INT_COLUMN_DECODERS: dict[int, Callable[[Any], int]] = {
+	**{dtype: _BASIC_DECODERS[dtype] for dtype in (
+		_mdt.Int8, _mdt.Int16, _mdt.Int32, _mdt.Int64,
+		_mdt.UInt8, _mdt.UInt16, _mdt.UInt32, _mdt.DateTime, _mdt.Boolean
+	)},
+	_mdt.UInt64: lambda m: _uint64(m.long_value),
+}
+_FLOAT_COLUMN_DECODERS: dict[int, Callable[[Any], float]] = {
+	_mdt.Float: _BASIC_DECODERS[_mdt.Float],
+	_mdt.Double: _BASIC_DECODERS[_mdt.Double],
+}
+
+
+def parse_metric_value(m, as_view: bool = False, datatype: Optional[int] = None):
+	"""Decodes the value of a metric according to its datatype, or the given datatype if set. With `as_view`, array values are returned
+	as views over the packed bytes (NumPy arrays if available, otherwise memoryviews) instead of tuples."""
+	if m.is_null:
+		return None
+	if datatype is None:
+		datatype = m.datatype
+	decoder = _METRIC_DECODERS.get(datatype)
+	if decoder is None:
+		raise NotImplementedError(f"Unhandled metric data type {datatype}")
+	return decoder(m, as_view)
@@ -0,0 +1,130 @@
+from itertools import count
+from typing import Any
+
+
+def validate_pattern(pattern: str) -> list[str]:
+	"""Splits an MQTT topic filter into its levels. Raises a ValueError if a `+` or `#` wildcard doesn't occupy a whole level, or `#` isn't last."""
+	levels = pattern.split("/")
+	for i, level in enumerate(levels):
+		if level == "#":
+			if i != len(levels) - 1:
+				raise ValueError(f"'#' must be the last level of topic filter {pattern}")
+		elif "#" in level or ("+" in level and level != "+"):
+			raise ValueError(f"Wildcards must occupy a whole level of topic filter {pattern}")
+	return levels
+
+def topic_matches(pattern: str, topic: str) -> bool:
+	"""Returns whether the topic matches the MQTT topic filter"""
+	pattern_levels = validate_pattern(pattern)
+	if topic.startswith("$") and pattern_levels[0] in ("+", "#"):
+		return False
+	levels = topic.split("/")
+	for i, level in enumerate(pattern_levels):
+		if level == "#":
+			return True
+		if i >= len(levels) or (level != "+" and level != levels[i]):
+			return False
+	return len(pattern_levels) == len(levels)
+
+
+class _Node:
+	__slots__ = ("children", "handlers", "multi_level_handlers")
+
+	def __init__(self) -> None:
+		self.children: dict[str, _Node] = {}
+		# Handlers of filters ending at this node, and of filters ending with a `#` following this node
+		self.handlers: list[tuple[int, Any]] = []
+		self.multi_level_handlers: list[tuple[int, Any]] = []
+
+
+class TopicRouter:
+	"""Routes topics to the handlers subscribed with MQTT topic filters, using `+` and `#` wildcards.
+
+	The filters are compiled into a trie with a level per node. Matches are cached per topic, since the same topics recur
+	on every message, and the cache is cleared whenever a handler is added or removed. As in MQTT, wildcards at the first
+	level don't match topics starting with `$`. Handlers can be any object, `dispatch` assumes they are callable.
+	"""
+
+	def __init__(self, cache_size: int = 1 << 16) -> None:
+		self._root = _Node()
+		self._order = count()
+		self._cache: dict[str, tuple[Any, ...]] = {}
+		self._cache_size = cache_size
+		self._count = 0
+
+	def __len__(self) -> int:
+		"""Returns the number of subscribed handlers"""
+		return self._count
+
+	def add(self, pattern: str, handler: Any) -> None:
+		"""Subscribes the handler to topics matching the filter"""
+		node = self._root
+		levels = validate_pattern(pattern)
+		multi_level = levels[-1] == "#"
+		if multi_level:
+			levels.pop()
+		for level in levels:
+			node = node.children.setdefault(level, _Node())
+		(node.multi_level_handlers if multi_level else node.handlers).append((next(self._order), handler))
+		self._count += 1
+		self._cache.clear()
+
+	def remove(self, pattern: str, handler: Any) -> bool:
+		"""Unsubscribes the handler from the filter. Returns whether it was subscribed."""
+		node = self._root
+		levels = validate_pattern(pattern)
+		multi_level = levels[-1] == "#"
+		if multi_level:
+			levels.pop()
+		for level in levels:
+			node = node.children.get(level)
+			if node is None:
+				return False
+		handlers = node.multi_level_handlers if multi_level else node.handlers
+		for i, (_, h) in enumerate(handlers):
+			if h is handler or h == handler:
+				del handlers[i]
+				self._count -= 1
+				self._cache.clear()
+				return True
+		return False
+
+	def match(self, topic: str) -> tuple[Any, ...]:
+		"""Returns the handlers subscribed to filters matching the topic, in the order they were added"""
+		handlers = self._cache.get(topic)
+		if handlers is None:
+			handlers = self._match(topic)
+			if len(self._cache) >= self._cache_size:
+				self._cache.clear()
+			self._cache[topic] = handlers
+		return handlers
+
+	def _match(self, topic: str) -> tuple[Any, ...]:
+		levels = topic.split("/")
+		system = topic.startswith("$")
+		matched = []
+		stack = [(self._root, 0)]
+		while stack:
+			node, i = stack.pop()
+			wildcards = not (system and i == 0)
+			if node.multi_level_handlers and wildcards:
+				matched.extend(node.multi_level_handlers)
+			if i == len(levels):
+				matched.extend(node.handlers)
+				continue
+			child = node.children.get(levels[i])
+			if child is not None:
+				stack.append((child, i + 1))
+			if wildcards:
+				child = node.children.get("+")
+				if child is not None:
+					stack.append((child, i + 1))
+		matched.sort(key=lambda entry: entry[0])
+		return tuple(handler for _, handler in matched)
+
+	def dispatch(self, topic: str, *args, **kwargs) -> int:
+		"""Calls each handler matching the topic with the topic and the given arguments. Returns the number of handlers called."""
+		handlers = self.match(topic)
+		for handler in handlers:
+			handler(topic, *args, **kwargs)
+		return len(handlers)
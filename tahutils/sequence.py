@@ -0,0 +1,27 @@
+import threading
+
+
+class SequenceCounter:
+	"""A thread-safe counter that wraps at 256, used for the Sparkplug `seq` and `bdSeq` numbers"""
+
+	def __init__(self, start: int = 0, modulus: int = 256) -> None:
+		self._modulus = modulus
+		self._value = start % modulus
+		self._lock = threading.Lock()
+
+	@property
+	def value(self) -> int:
+		"""Returns the number the next call to `next` will return"""
+		return self._value
+
+	def next(self) -> int:
+		"""Returns the current number and advances the counter"""
+		with self._lock:
+			r = self._value
+			self._value = (r + 1) % self._modulus
+		return r
+
+	def reset(self, value: int = 0) -> None:
+		"""Resets the counter so that the next call to `next` returns the given value"""
+		with self._lock:
+			self._value = value % self._modulus
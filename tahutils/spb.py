@@ -1,13 +1,22 @@
-from dataclasses import dataclass
+import os
+from dataclasses import dataclass, replace
 from enum import Enum
-from functools import cached_property
-from typing import Any, Optional, Union
-
+from functools import cached_property, lru_cache
+from time import perf_counter
+from typing import Any, Callable, Iterable, NamedTuple, Optional, Union
+
+from tahutils.compression import Compression, compress_payload
+from tahutils.deadband import Deadband
+from tahutils.encoding import MetricEncoder, compile_encoder
+from tahutils.instrumentation import Instrumentation
+from tahutils.sequence import SequenceCounter
 from tahutils.tahu import sparkplug_b as spb
-from tahutils.types import MetricName, MetricTimes, MetricValues
+from tahutils.types import MetricName, MetricTimes, MetricValues, Time
 from tahutils.utils import convert_enum_keys, \
 	flatten_data_dict, process_times, make_key, \
-	dataclass_to_dict, instance_to_dict
+	dataclass_to_dict, instance_to_dict, current_time_ms, dataclass_metadata, time_to_ms, values_equal, \
+	DataclassFlattener, load_alias_map, save_alias_map
+from tahutils.wire import WireEncoder, WireMetric, WirePayload, compile_wire_metric
 
 from dataclasses import is_dataclass
 
@@ -18,6 +27,22 @@ class CommandMetric(Enum):
 
 COMMAND_METRICS_SET = {m.value for m in CommandMetric}
 
+_BD_SEQ_ENCODER = compile_encoder("bdSeq", None, spb.MetricDataType.Int64)
+
+def _metric_count(payload: Union[spb.Payload, "WirePayload"]) -> int:
+	return payload.metric_count if isinstance(payload, WirePayload) else len(payload.metrics)
+
+class ParsedTopic(NamedTuple):
+	"""The parts of a Sparkplug topic. For STATE topics the group and edge node are `None` and `host_id` is set.
+	`topic` is the SpbTopic of the node or device, shared by every parse of its topics."""
+	namespace: str
+	group_id: Optional[str]
+	message_type: str
+	edge_node_id: Optional[str]
+	device_id: Optional[str]
+	host_id: Optional[str] = None
+	topic: Optional["SpbTopic"] = None
+
 @dataclass(frozen=True)
 class SpbTopic:
 	group_id: str
@@ -27,6 +52,12 @@ class SpbTopic:
 
 	namespace: str = "spBv1.0"
 
+	@staticmethod
+	def parse(topic: str) -> ParsedTopic:
+		"""Parses a Sparkplug topic string, including STATE topics in both the `spBv1.0/STATE/<host_id>` and older `STATE/<host_id>` forms.
+		Parses are cached, so repeated topics cost a dict lookup. Raises a ValueError if the topic isn't a Sparkplug topic."""
+		return _parse_topic(topic)
+
 	@property
 	def template_string(self):
 		return f"{self.namespace}/{self.group_id}/%s/{self.edge_node_id}/{self.device_id}" \
@@ -115,6 +146,38 @@ class SpbTopic:
 	def STATE(self):
 		return self.construct("STATE")
 
+@lru_cache(maxsize=1 << 16)
+def _intern_topic(namespace: str, group_id: str, edge_node_id: str, device_id: Optional[str]) -> SpbTopic:
+	"""Returns a single SpbTopic instance per node or device, so their topic strings are only constructed once"""
+	return SpbTopic(group_id=group_id, edge_node_id=edge_node_id, device_id=device_id, namespace=namespace)
+
+@lru_cache(maxsize=1 << 16)
+def _parse_topic(topic: str) -> ParsedTopic:
+	parts = topic.split("/")
+	if len(parts) == 2 and parts[0] == "STATE" and parts[1]:
+		return ParsedTopic(namespace="", group_id=None, message_type="STATE", edge_node_id=None, device_id=None, host_id=parts[1])
+	if len(parts) == 3 and parts[1] == "STATE" and parts[2]:
+		return ParsedTopic(namespace=parts[0], group_id=None, message_type="STATE", edge_node_id=None, device_id=None, host_id=parts[2])
+	if len(parts) not in (4, 5) or not all(parts):
+		raise ValueError(f"Invalid Sparkplug topic {topic}")
+
+	namespace, group_id, message_type, edge_node_id = parts[:4]
+	device_id = parts[4] if len(parts) == 5 else None
+	if message_type not in _MESSAGE_TYPES:
+		raise ValueError(f"Invalid Sparkplug message type {message_type} in topic {topic}")
+	if (device_id is not None) != message_type.startswith("D"):
+		raise ValueError(f"Invalid Sparkplug topic {topic}, device message types must have a device id and node message types must not")
+	return ParsedTopic(
+		namespace=namespace,
+		group_id=group_id,
+		message_type=message_type,
+		edge_node_id=edge_node_id,
+		device_id=device_id,
+		topic=_intern_topic(namespace, group_id, edge_node_id, device_id)
+	)
+
+_MESSAGE_TYPES = {"NBIRTH", "NDEATH", "NDATA", "NCMD", "DBIRTH", "DDEATH", "DDATA", "DCMD"}
+
 class SpbModel:
 	def __init__(
 			self, 
@@ -125,13 +188,41 @@ class SpbModel:
 			flatten_states: bool=True,
 			flattened_dict_delimiter: str = "/",
 			is_device = False,
-			topic: Optional[SpbTopic] = None
+			topic: Optional[SpbTopic] = None,
+			node: Optional["SpbModel"] = None,
+			deadbands: Optional[dict[MetricName, Deadband]] = None,
+			aliases: Optional[Union[dict[MetricName, int], str, os.PathLike]] = None,
+			alias_only_data: bool = False,
+			clock: Optional[Callable[[], int]] = None,
+			omit_metric_timestamps: bool = False,
+			compression: Optional[Compression] = None,
+			compression_threshold: int = 1024,
+			wire_encoding: bool = False,
+			instrumentation: Optional[Instrumentation] = None
 		) -> None:
 
 		self.topic = topic
 		self.is_device = is_device
 
+		# The clock returns milliseconds since the epoch, and is read once per payload
+		self.clock = clock or current_time_ms
+		self.omit_metric_timestamps = omit_metric_timestamps
+
+		if node is not None and (not is_device or node.is_device):
+			raise ValueError("Only device models can be attached to a node model")
+		if is_device and node is None:
+			raise ValueError("Device models must be attached to their node's model with `node`, to share its seq numbers")
+		self.node = node
+
+		# Devices share their node's seq space. Only nodes track bdSeq.
+		self.seq_counter = node.seq_counter if is_device else SequenceCounter()
+		self.bd_seq_counter = None if is_device else SequenceCounter()
+		self._bd_seq = None
+
+		self._flatteners: dict[type, DataclassFlattener] = {}
+
 		if is_dataclass(metrics):
+			deadbands = dataclass_metadata(metrics, Deadband) | (deadbands or {})
 			metrics = dataclass_to_dict(metrics)
 
 		self.flatten_states = flatten_states
@@ -150,20 +241,68 @@ class SpbModel:
 			self.all_metrics = self.metrics
 		else:
 			self.all_metrics = COMMAND_METRICS_SET | self.metrics
-		self._metric_to_alias = {metric: i for i, metric in enumerate(self.all_metrics)} \
+		self._alias_table = self._assignAliases(aliases) if self._use_aliases else {}
+		self._metric_to_alias = {metric: self._alias_table[metric] for metric in self.all_metrics} \
 			if self._use_aliases else \
 			{metric: None for metric in self.all_metrics}
 		
-		self._alias_to_metric = {i: metric for i, metric in self._metric_to_alias.items()} \
+		self._alias_to_metric = {alias: metric for metric, alias in self._metric_to_alias.items()} \
 			if self._use_aliases else None
 
+		self._encoders: dict[str, MetricEncoder] = {
+			metric: compile_encoder(metric, self._metric_to_alias[metric], self.metric_types[metric])
+			for metric in self.all_metrics
+		}
+
+		# Births always carry names. Data payloads can identify metrics by alias alone.
+		if alias_only_data and not use_aliases:
+			raise ValueError("Alias-only data payloads require aliases")
+		self.alias_only_data = alias_only_data
+		self._data_encoders = {metric: replace(encoder, name=None) for metric, encoder in self._encoders.items()} \
+			if alias_only_data else \
+			self._encoders
+
 		self.auto_serialize = auto_serialize
 		self.serialize_cast = serialize_cast
 
+		# Payloads smaller than the threshold (in serialized bytes) aren't worth compressing
+		self.compression = compression
+		self.compression_threshold = compression_threshold
+
+		# Data payloads can be written straight to the wire format, without building protobuf messages.
+		# DataSets and Templates can't be, so payloads carrying them are still built with the protobuf classes.
+		if wire_encoding and not auto_serialize:
+			raise ValueError("Wire encoding requires auto_serialize")
+		self._wire = WireEncoder() if wire_encoding else None
+		self._protobuf_metrics = {metric for metric, encoder in self._data_encoders.items() if encoder.is_message}
+		self._wire_encoders: dict[str, WireMetric] = {
+			metric: compile_wire_metric(encoder.name, encoder.alias, encoder.datatype)
+			for metric, encoder in self._data_encoders.items()
+			if not encoder.is_message
+		} if wire_encoding else {}
+
+		# Counters and timings of the payloads encoded, if enabled
+		self.instrumentation = instrumentation
+
 		self.node_death_requested = self.is_device
 
 		self._last_death = None
 
+		self._pending: dict[str, Any] = {}
+		# Changes held back by a minimum publish interval, published by the next data payload or flush once it has passed
+		self._held: dict[str, Any] = {}
+
+		self.deadbands: dict[str, Deadband] = self._preprocess_dict(deadbands) if deadbands else {}
+		if not self.deadbands.keys() <= self.all_metrics:
+			raise ValueError("Deadbands must be for a subset of the model's metrics")
+		self._heartbeat_metrics = [m for m, d in self.deadbands.items() if d.max_interval is not None]
+		# A DataSet or Template republished by its maximum interval can be added to any data payload, so none can be wire encoded
+		if not self._protobuf_metrics.isdisjoint(self._heartbeat_metrics):
+			self._wire = None
+		self._published_at: dict[str, int] = {}
+		# The latest value of each deadbanded metric whose change was within its deadband, republished by its maximum interval
+		self._unpublished: dict[str, Any] = {}
+
 	@property
 	def aliasing(self) -> bool:
 		"""Returns whether aliases are being used"""
@@ -178,15 +317,84 @@ class SpbModel:
 		key = make_key(*args, delimiter=self.flattened_dict_delimiter)
 		return self.current_values.get(key, None)
 
+	@property
+	def dirty(self) -> bool:
+		"""Returns whether any values set since the last flush, or held back by a minimum interval, differ from the published values"""
+		return bool(self._pending or self._held)
+
+	def _setPending(self, metric: str, value: Any) -> None:
+		"""Records the value as pending if it differs from the published value, otherwise discards any pending value"""
+		if metric not in self._encoders:
+			raise ValueError(f"{metric} is not one of the model's metrics")
+		if self._held:
+			self._held.pop(metric, None)
+		if values_equal(value, self.current_values.get(metric, ...)):
+			self._pending.pop(metric, None)
+		else:
+			self._pending[metric] = value
+
+	def set(self, metric: Union[MetricName, tuple[MetricName, ...]], value: Any) -> None:
+		"""Sets a single metric's value to be published by the next `flush`. Nested metrics can be given as a tuple of keys."""
+		if isinstance(metric, tuple):
+			metric = make_key(*metric, delimiter=self.flattened_dict_delimiter)
+		elif isinstance(metric, Enum):
+			metric = metric.value
+		self._setPending(metric, value)
+
+	def update(self, state: MetricValues) -> None:
+		"""Sets the values of all metrics in the state to be published by the next `flush`. The state does not need to contain every metric."""
+		for metric, value in self._preprocess_dict(state).items():
+			self._setPending(metric, value)
+
 	def _preprocess_dict(self, state: MetricValues, is_time: bool = False) -> MetricValues:
 		"""Preprocesses the state, flattening it if enabled, and converting enum keys. Can optionally preprocess times."""
 		if is_dataclass(state):
+			if self.flatten_states:
+				return self._flattenDataclass(state, is_time)
 			state = instance_to_dict(state)
 		r = flatten_data_dict(state, delimiter=self.flattened_dict_delimiter) if self.flatten_states else convert_enum_keys(state)
 		if is_time:
 			r = process_times(r)
 		return r
 
+	def _flattenDataclass(self, instance, is_time: bool = False) -> MetricValues:
+		"""Flattens a dataclass instance with a flattener compiled once per class"""
+		cls = type(instance)
+		flattener = self._flatteners.get(cls)
+		if flattener is None:
+			flattener = self._flatteners[cls] = DataclassFlattener(cls, self.flattened_dict_delimiter)
+		r = flattener(instance)
+		if is_time:
+			r = process_times(r)
+		return r
+
+	def _assignAliases(self, aliases: Optional[Union[dict[MetricName, int], str, os.PathLike]]) -> dict[str, int]:
+		"""Builds the alias table from an explicit map or a saved alias file, if given. Metrics without an alias are assigned new ones
+		in sorted order, after the highest existing alias. If a file was given and new aliases were assigned, the file is updated."""
+		path = None
+		if isinstance(aliases, (str, os.PathLike)):
+			path = aliases
+			aliases = load_alias_map(path) if os.path.exists(path) else {}
+		table = convert_enum_keys(aliases) if aliases else {}
+		if len(set(table.values())) != len(table):
+			raise ValueError("Aliases must be unique")
+
+		new_metrics = sorted(self.all_metrics - table.keys())
+		next_alias = max(table.values(), default=-1) + 1
+		for alias, metric in enumerate(new_metrics, start=next_alias):
+			table[metric] = alias
+
+		if path is not None and new_metrics:
+			save_alias_map(path, table)
+		return table
+
+	def saveAliases(self, path: Union[str, os.PathLike]) -> None:
+		"""Saves the alias table to a file, which can be passed as `aliases` to keep aliases stable across restarts.
+		Aliases loaded for metrics no longer in the model are kept, so they aren't reused. Raises a ValueError if aliases are not being used."""
+		if not self._use_aliases:
+			raise ValueError("Aliases are not being used")
+		save_alias_map(path, self._alias_table)
+
 	def aliasToMetric(self, alias: int) -> str:
 		"""Returns the metric for the given alias. Raises a ValueError if aliases are not being used."""
 		if not self._use_aliases:
@@ -201,21 +409,109 @@ class SpbModel:
 			raise ValueError("Aliases are not being used")
 		return self._metric_to_alias[metric]
 	
-	def _serialize(self, p: spb.Payload) -> Union[bytes, spb.Payload]:
-		"""Serializes the payload if auto_serialize is True, otherwise is a no-op."""
-		if self.auto_serialize:
-			if self.serialize_cast is not None:
-				return self.serialize_cast(p.SerializeToString())
-			return p.SerializeToString()
-		return p
+	def _serialize(
+			self,
+			p: Union[spb.Payload, WirePayload],
+			kind: str = "DATA",
+			started: float = 0,
+			suppressed: int = 0
+		) -> Union[bytes, spb.Payload]:
+		"""Serializes the payload with `_encodePayload` and casts it with `serialize_cast`, recording it in the instrumentation if enabled.
+		`kind` is the message type without its N/D prefix, and `started` the `perf_counter` time the payload was started at."""
+		if self.instrumentation is None:
+			data = self._encodePayload(p)
+			return data if isinstance(data, spb.Payload) else self._cast(data)
+		metrics = _metric_count(p)
+		data = self._encodePayload(p)
+		if isinstance(data, spb.Payload):
+			out, size = data, data.ByteSize()
+		else:
+			# Measured before the cast, which may not return bytes, e.g. when appending to a PayloadBuffer
+			out, size = self._cast(data), len(data)
+		message_type = ("D" if self.is_device else "N") + kind
+		self.instrumentation.recordEncode(message_type, metrics, size, perf_counter() - started, suppressed)
+		return out
+
+	def _cast(self, data: Union[bytes, bytearray]) -> Any:
+		"""Applies `serialize_cast` to the serialized payload, or converts it to bytes if there is none.
+		A wire payload's bytearray belongs to the payload alone, so it is handed over without copying when the cast is bytearray."""
+		if self.serialize_cast is bytearray and type(data) is bytearray:
+			return data
+		return (self.serialize_cast or bytes)(data)
+
+	def _encodePayload(self, p: Union[spb.Payload, WirePayload]) -> Union[bytes, bytearray, spb.Payload]:
+		"""Returns the serialized payload if auto_serialize is True, otherwise the payload itself.
+		Payloads at least `compression_threshold` bytes long are compressed first if compression is enabled."""
+		if isinstance(p, WirePayload):
+			data = p.finish()
+			if self.compression is None or len(data) < self.compression_threshold:
+				return data
+			p = spb.Payload.FromString(bytes(data))
+		if self.compression is not None and p.ByteSize() >= self.compression_threshold:
+			p = compress_payload(p, self.compression)
+		return p.SerializeToString() if self.auto_serialize else p
 	
+	def _newPayload(
+			self,
+			timestamp: Optional[int] = None,
+			template: Optional[spb.Payload] = None,
+			seq: Optional[int] = None
+		) -> spb.Payload:
+		"""Creates a payload stamped with the given time (or now) and sequence number (or the next one), copying the metrics of the template if given"""
+		payload = spb.Payload()
+		if template is not None:
+			payload.CopyFrom(template)
+		payload.timestamp = timestamp if timestamp is not None else self.clock()
+		payload.seq = seq if seq is not None else self.seq_counter.next()
+		return payload
+
+	def _newDataPayload(self, metrics: Iterable[str] = (), seq: Optional[int] = None) -> Union[spb.Payload, WirePayload]:
+		"""Creates a data payload for the given metrics, written straight to the wire format if wire encoding is enabled
+		and none of them is a DataSet or Template"""
+		if self._wire is not None and self._protobuf_metrics.isdisjoint(metrics):
+			return self._wire.payload(self.clock(), seq if seq is not None else self.seq_counter.next())
+		return self._newPayload(seq=seq)
+
+	def _metricTimestamp(self, payload: Union[spb.Payload, WirePayload], now: int) -> Optional[int]:
+		"""Returns the timestamp for metrics stamped at `now`, or `None` if metric timestamps equal to the payload's are omitted"""
+		return None if self.omit_metric_timestamps and now == payload.timestamp else now
+
+	def _newNodeBirthPayload(self, template: Optional[spb.Payload] = None) -> spb.Payload:
+		"""Creates a node birth payload, restarting the sequence and carrying the bdSeq of the last death.
+		A birth template already declares the bdSeq as its first metric."""
+		self.seq_counter.reset()
+		payload = self._newPayload(template=template)
+		bd_seq = self._bd_seq if self._bd_seq is not None else (self.bd_seq_counter.value - 1) % 256
+		stamp = self._metricTimestamp(payload, payload.timestamp)
+		if template is not None:
+			_BD_SEQ_ENCODER.fill(payload.metrics[0], bd_seq, stamp)
+		else:
+			_BD_SEQ_ENCODER.encode(payload, bd_seq, stamp)
+		return payload
+
+	@cached_property
+	def _birth_template(self) -> tuple[spb.Payload, list[tuple[str, MetricEncoder]]]:
+		"""A payload declaring every metric of a birth, and the metrics and encoders in the order they are declared.
+		Births copy it and only fill in the values and timestamps."""
+		template = spb.Payload()
+		if not self.is_device:
+			_BD_SEQ_ENCODER.declare(template)
+		order = [(metric, self._encoders[metric]) for metric in self.metric_types]
+		for _, encoder in order:
+			encoder.declare(template)
+		return template, order
+
 	def getDeathPayload(self):
 		"""Returns a death payload for the node. This must be requested and sent as part of the connection."""
+		started = perf_counter() if self.instrumentation is not None else 0
 		self.node_death_requested = True
 		if self.is_device:
-			self._last_death = self._serialize(spb.getDdataPayload())
+			self._last_death = self._serialize(self._newPayload(), "DEATH", started)
 		else:
-			self._last_death = self._serialize(spb.getNodeDeathPayload())
+			payload = spb.Payload()
+			self._bd_seq = self.bd_seq_counter.next()
+			_BD_SEQ_ENCODER.encode(payload, self._bd_seq, self.clock())
+			self._last_death = self._serialize(payload, "DEATH", started)
 		return self._last_death
 	
 	def getBirthPayload(
@@ -227,6 +523,7 @@ class SpbModel:
 			timestamp_override: Optional[int] = None
 		):
 		"""Returns a birth payload for the given state. State must be set for all metrics. Times can be set for specific metrics, if desired."""
+		started = perf_counter() if self.instrumentation is not None else 0
 		state = self._preprocess_dict(state)
 		times = self._preprocess_dict(times, is_time=True)
 		
@@ -236,36 +533,37 @@ class SpbModel:
 		if not rebirth and set(expected_keys) != set(self.all_metrics):
 			raise ValueError("Node birth metrics must be the same as the model's metrics")
 
-		if self.is_device:
-			payload = spb.getDeviceBirthPayload()
-		else:
-			payload = spb.getNodeBirthPayload()
-
 		if not self.is_device:
 			for metric in COMMAND_METRICS_SET:
 				if metric not in state:
 					state[metric] = False
 
-		for metric, value in state.items():
-			mt = self.metric_types[metric]
-
-			self.current_values[metric] = value
-
-			if metric in times:
-				spb.addMetric(payload, metric, self._metric_to_alias[metric], mt, value, times[metric])
-			elif timestamp_override is not None:
-				spb.addMetric(payload, metric, self._metric_to_alias[metric], mt, value, timestamp_override)
-			else:
-				spb.addMetric(payload, metric, self._metric_to_alias[metric], mt, value)
+		# Once every metric has a value, which is always the case after the first birth, the birth is filled in from the template
+		current_values = self.current_values
+		current_values.update(state)
+		template, order = self._birth_template if len(current_values) == len(self._encoders) else (None, None)
 
-		if rebirth:
-			for metric in set(self.current_values.keys()).difference(state.keys()):
-				value = self.current_values[metric]
-				mt = self.metric_types[metric]
+		if self.is_device:
+			payload = self._newPayload(template=template)
+		else:
+			payload = self._newNodeBirthPayload(template)
+
+		now = timestamp_override if timestamp_override is not None else payload.timestamp
+		stamp = self._metricTimestamp(payload, now)
+		if template is not None:
+			declared = payload.metrics if self.is_device else payload.metrics[1:]
+			for metric, (name, encoder) in zip(declared, order):
+				encoder.fill(metric, current_values[name], times.get(name, stamp))
+		else:
+			# Only possible for a rebirth before all metrics have been born, which sends the known metrics only
+			encoders = self._encoders
+			for metric, value in current_values.items():
+				encoders[metric].encode(payload, value, times.get(metric, stamp))
 
-				spb.addMetric(payload, metric, self._metric_to_alias[metric], mt, value)
+		for metric in self.deadbands:
+			self._published_at[metric] = now
 
-		return self._serialize(payload)
+		return self._serialize(payload, "BIRTH", started)
 	
 	def getDataPayload(
 			self, 
@@ -274,47 +572,177 @@ class SpbModel:
 			timestamp_override: Optional[int] = None
 		):
 		"""Returns a data payload for the given state. Times can be set for specific metrics, if desired."""
+		started = perf_counter() if self.instrumentation is not None else 0
 		state = self._preprocess_dict(state)
 		times = self._preprocess_dict(times, is_time=True)
 		
 		if not set(state.keys()).issubset(set(self.all_metrics)):
 			raise ValueError("Node data metrics must be a subset of the model's metrics")
 
-		payload = spb.getDdataPayload()
+		# Earlier changes held back by a minimum interval are sent once it has passed, unless the state supersedes them
+		if self._held:
+			state = {**self._held, **state}
+			self._held = {}
+		payload = self._newDataPayload(state)
+		now = timestamp_override if timestamp_override is not None else payload.timestamp
+		suppressed = self._addChangedMetrics(payload, state, times, now, held=self._held)
+		return self._serialize(payload, "DATA", started, suppressed)
+
+	def getHistoricalDataPayload(
+			self,
+			samples: Iterable[tuple[Time, MetricValues]],
+			timestamp_override: Optional[int] = None
+		):
+		"""Returns a single data payload containing the changes across a sequence of (timestamp, state) samples, each metric stamped with its sample's time.
+		For each metric only the latest value is sent as current, earlier values are marked as historical. The model's values are advanced to the latest sample."""
+		started = perf_counter() if self.instrumentation is not None else 0
+		samples = sorted(
+			((time_to_ms(t), self._preprocess_dict(state)) for t, state in samples),
+			key=lambda sample: sample[0]
+		)
+		for _, state in samples:
+			if not state.keys() <= self.all_metrics:
+				raise ValueError("Node data metrics must be a subset of the model's metrics")
+
+		payload = self._newPayload(timestamp_override)
+		published = []
+		suppressed = 0
+		for t, state in samples:
+			suppressed += self._addChangedMetrics(payload, state, {}, t, published=published)
+
+		seen = set()
+		for i in range(len(published) - 1, -1, -1):
+			if published[i] in seen:
+				payload.metrics[i].is_historical = True
+			else:
+				seen.add(published[i])
+
+		return self._serialize(payload, "DATA", started, suppressed)
+
+	def compareDataPayloadSizes(self, state: MetricValues) -> dict[str, int]:
+		"""Returns the serialized sizes in bytes of a data payload carrying every metric in the state, with metrics identified by
+		"names", by "names_and_aliases", and by "aliases" only. Doesn't change the model's state. If aliases aren't being used,
+		the aliases they would be assigned are used."""
+		state = self._preprocess_dict(state)
+		if not state.keys() <= self.all_metrics:
+			raise ValueError("Node data metrics must be a subset of the model's metrics")
+		aliases = self._alias_table if self._use_aliases else \
+			{metric: alias for alias, metric in enumerate(sorted(self.all_metrics))}
+
+		now = self.clock()
+		sizes = {}
+		for mode, use_names, use_aliases in (
+				("names", True, False),
+				("names_and_aliases", True, True),
+				("aliases", False, True)
+			):
+			payload = spb.Payload(timestamp=now, seq=0)
+			stamp = self._metricTimestamp(payload, now)
+			for metric, value in state.items():
+				encoder = replace(
+					self._encoders[metric],
+					name=metric if use_names else None,
+					alias=aliases[metric] if use_aliases else None
+				)
+				encoder.encode(payload, value, stamp)
+			sizes[mode] = payload.ByteSize()
+		return sizes
+
+	def flush(
+			self,
+			times: MetricTimes = dict(),
+			timestamp_override: Optional[int] = None,
+			skip_empty: bool = False,
+			force: bool = False
+		):
+		"""Returns a data payload containing only the metrics changed through `set` or `update` since the last flush.
+		With `skip_empty`, returns `None` without using a sequence number if no metric would be published.
+		With `force`, changes held back by a minimum publish interval are published regardless."""
+		started = perf_counter() if self.instrumentation is not None else 0
+		times = self._preprocess_dict(times, is_time=True)
 
+		pending, self._pending = self._pending, {}
+		if self._held:
+			pending = {**self._held, **pending}
+			self._held = {}
+		# The sequence number is only taken once the payload is known to be published
+		payload = self._newDataPayload(pending, seq=0)
+		now = timestamp_override if timestamp_override is not None else payload.timestamp
+		# Changes held back by a minimum publish interval stay held for the next flush
+		suppressed = self._addChangedMetrics(payload, pending, times, now, held=self._held, min_intervals=not force)
+		if skip_empty and _metric_count(payload) == 0:
+			return None
+		payload.seq = self.seq_counter.next()
+		return self._serialize(payload, "DATA", started, suppressed)
+
+	def heldUntil(self) -> Optional[int]:
+		"""Returns the time at which the earliest change held back by a minimum publish interval can be published, or `None` if none is"""
+		deadbands = self.deadbands
+		published_at = self._published_at
+		times = [published_at[metric] + deadbands[metric].min_interval for metric in self._held]
+		return min(times) if times else None
+
+	def _addChangedMetrics(
+			self,
+			payload: Union[spb.Payload, WirePayload],
+			state: dict[str, Any],
+			times: dict[str, int],
+			now: int,
+			held: Optional[dict[str, Any]] = None,
+			published: Optional[list[str]] = None,
+			min_intervals: bool = True
+		) -> int:
+		"""Adds each metric in the state whose change should be reported to the payload, and records it as published.
+		Metrics with deadbands are filtered by them, and changes held back by a minimum interval (unless `min_intervals` is False) are added to `held` if given.
+		The names of the metrics added are appended to `published` if given. Returns the number of metrics in the state that weren't added."""
+		before = _metric_count(payload)
+		stamp = self._metricTimestamp(payload, now)
+		encoders = self._wire_encoders if isinstance(payload, WirePayload) else self._data_encoders
+		current_values = self.current_values
+		deadbands = self.deadbands
+		published_at = self._published_at
+		unpublished = self._unpublished
 		for metric, value in state.items():
-			if value != self.current_values.get(metric, ...):
-				mt = self.metric_types[metric]
-				self.current_values[metric] = value
-			
-				if metric in times:
-					spb.addMetric(
-						payload, 
-						metric, 
-						self._metric_to_alias[metric], 
-						mt, 
-						value, 
-						times[metric]
-					)
-				elif timestamp_override is not None:
-					spb.addMetric(
-						payload, 
-						metric, 
-						self._metric_to_alias[metric], 
-						mt, 
-						value, 
-						timestamp_override
-					)
-				else:
-					spb.addMetric(
-						payload, 
-						metric, 
-						self._metric_to_alias[metric], 
-						mt, 
-						value
-					)
-
-		return self._serialize(payload)
+			last = current_values.get(metric, ...)
+			deadband = deadbands.get(metric) if deadbands else None
+			if deadband is None:
+				try:
+					if value == last:
+						continue
+				except ValueError:
+					# Elementwise comparisons, e.g. NumPy array values
+					if values_equal(value, last):
+						continue
+			elif last is not ... and metric in published_at:
+				elapsed = now - published_at[metric]
+				if deadband.max_interval is None or elapsed < deadband.max_interval:
+					if not deadband.exceeded(value, last):
+						unpublished[metric] = value
+						continue
+					if min_intervals and deadband.min_interval is not None and elapsed < deadband.min_interval:
+						if held is not None:
+							held[metric] = value
+						continue
+			if deadband is not None:
+				published_at[metric] = now
+				unpublished.pop(metric, None)
+
+			current_values[metric] = value
+			encoders[metric].encode(payload, value, times.get(metric, stamp))
+			if published is not None:
+				published.append(metric)
+		suppressed = len(state) - (_metric_count(payload) - before)
+
+		# Republish metrics whose maximum interval has passed without a change being reported
+		for metric in self._heartbeat_metrics:
+			if metric in published_at and metric in current_values \
+					and now - published_at[metric] >= deadbands[metric].max_interval:
+				published_at[metric] = now
+				value = current_values[metric] = unpublished.pop(metric, current_values[metric])
+				encoders[metric].encode(payload, value, times.get(metric, stamp))
+				if published is not None:
+					published.append(metric)
+		return suppressed
 
 
 	
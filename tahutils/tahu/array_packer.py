@@ -16,19 +16,56 @@
 
 
 import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 #/********************************************************************************
 # * Purpose of the module is to provide helper function for encoding and decoding
 # * of Array Types ( 22 - 34 ) according to SparkPlug B Specification 
 # *
 # * The module uses built-in struct module for packing and unpacking of bytes
+# *
+# * If NumPy is installed, ndarrays are packed directly from their buffers, and
+# * the un-packing functions can return read-only views over the packed bytes
+# * (as_view=True) instead of tuples
 # ********************************************************************************/
 
 # Packing template function using in-built struct module
 def convert_to_packed_bytes(array, format_specifier):
+    if np is not None and isinstance(array, np.ndarray):
+        # little endian dtype matching the struct format, no copy if the array already has it
+        dtype = np.dtype('<' + format_specifier)
+        if array.dtype != dtype:
+            check_packable_array(array, dtype, format_specifier)
+        return array.astype(dtype, copy=False).tobytes()
     packed_bytes = struct.pack('<{}{}'.format(len(array), format_specifier), *array)
     return packed_bytes
 
+# Raises the error that packing the values with struct would, instead of casting them unsafely
+def check_packable_array(array, dtype, format_specifier):
+    if not array.size:
+        return
+    if dtype.kind in 'iu':
+        if array.dtype.kind not in 'biu':
+            raise struct.error('required argument is not an integer')
+        if array.dtype.kind != 'b':
+            info = np.iinfo(dtype)
+            if int(array.min()) < info.min or int(array.max()) > info.max:
+                raise struct.error("'{}' format requires {} <= number <= {}".format(format_specifier, info.min, info.max))
+    elif dtype.kind == 'f':
+        if array.dtype.kind not in 'biuf':
+            raise struct.error('required argument is not a float')
+        # finite values too large for the format become inf when cast, which struct refuses
+        if array.dtype.kind == 'f' and array.dtype.itemsize > dtype.itemsize:
+            with np.errstate(over='ignore'):
+                overflowed = np.isinf(array.astype(dtype)) & np.isfinite(array)
+            if overflowed.any():
+                raise OverflowError('float too large to pack with {} format'.format(format_specifier))
+
 # Functions for packing each type of array as mentioned in the SparkPlug B Specification
 def convert_to_packed_int8_array(array):
     return convert_to_packed_bytes(array, 'b')
@@ -61,6 +98,10 @@ def convert_to_packed_double_array(array):
     return convert_to_packed_bytes(array, 'd')
 
 def convert_to_packed_boolean_array(boolean_array):
+    if np is not None and isinstance(boolean_array, np.ndarray):
+        # every element is packed, so the count is the size rather than the length of the first axis
+        packed_bytes = np.packbits(boolean_array.astype(bool, copy=False), bitorder='little').tobytes()
+        return struct.pack("<I", boolean_array.size) + packed_bytes
     # calculate the number of packed bytes required
     packed_bytes_count = (len(boolean_array) + 7) // 8
     # convert the boolean array into a packed byte string
@@ -85,62 +126,78 @@ def convert_to_packed_datetime_array(array):
 
 
 
+# Bits of every byte value, least significant first, used to un-pack boolean arrays a byte at a time
+_BYTE_BITS = [tuple((byte >> i) & 1 for i in range(8)) for byte in range(256)]
+
 # Un-packing template function
-def convert_from_packed_bytes(packed_bytes, format_specifier, length):
+def convert_from_packed_bytes(packed_bytes, format_specifier, length, as_view=False):
+    if as_view:
+        # zero-copy views over the packed bytes, NumPy if available and otherwise a memoryview on little endian hosts
+        if np is not None:
+            return np.frombuffer(packed_bytes, dtype='<' + format_specifier, count=length)
+        if sys.byteorder == 'little':
+            size = struct.calcsize(format_specifier)
+            return memoryview(packed_bytes)[:length * size].cast(format_specifier)
     return struct.unpack('<{}{}'.format(length, format_specifier), packed_bytes)
 
 # Functions for un-packing packed byte arrays for every type
-def convert_from_packed_int8_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'b', len(packed_bytes))
+def convert_from_packed_int8_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'b', len(packed_bytes), as_view)
 
-def convert_from_packed_int16_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'h', len(packed_bytes) // 2)
+def convert_from_packed_int16_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'h', len(packed_bytes) // 2, as_view)
 
-def convert_from_packed_int32_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'i', len(packed_bytes) // 4)
+def convert_from_packed_int32_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'i', len(packed_bytes) // 4, as_view)
 
-def convert_from_packed_int64_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'q', len(packed_bytes) // 8)
+def convert_from_packed_int64_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'q', len(packed_bytes) // 8, as_view)
 
-def convert_from_packed_uint8_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'B', len(packed_bytes))
+def convert_from_packed_uint8_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'B', len(packed_bytes), as_view)
 
-def convert_from_packed_uint16_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'H', len(packed_bytes) // 2)
+def convert_from_packed_uint16_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'H', len(packed_bytes) // 2, as_view)
 
-def convert_from_packed_uint32_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'I', len(packed_bytes) // 4)
+def convert_from_packed_uint32_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'I', len(packed_bytes) // 4, as_view)
 
-def convert_from_packed_uint64_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'Q', len(packed_bytes) // 8)
+def convert_from_packed_uint64_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'Q', len(packed_bytes) // 8, as_view)
 
-def convert_from_packed_float_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'f', len(packed_bytes) // 4)
+def convert_from_packed_float_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'f', len(packed_bytes) // 4, as_view)
 
-def convert_from_packed_double_array(packed_bytes):
-    return convert_from_packed_bytes(packed_bytes, 'd', len(packed_bytes) // 8)
+def convert_from_packed_double_array(packed_bytes, as_view=False):
+    return convert_from_packed_bytes(packed_bytes, 'd', len(packed_bytes) // 8, as_view)
 
-def convert_from_packed_boolean_array(packed_bytes):
+def convert_from_packed_boolean_array(packed_bytes, as_view=False):
     # unpack the 4-byte integer representing the number of boolean values
-    boolean_count, = struct.unpack("<I", packed_bytes[:4])
-    # unpack the packed bytes into a list of booleans
-    boolean_array = []
-    for i in range(boolean_count):
-        # True is represented by 1 and False by 0 in the array
-        boolean_array.append((packed_bytes[4 + i // 8] >> (i % 8)) & 1)
+    boolean_count, = struct.unpack_from("<I", packed_bytes)
+    if as_view and np is not None:
+        bits = np.unpackbits(np.frombuffer(packed_bytes, dtype=np.uint8, offset=4), count=boolean_count, bitorder='little')
+        return bits.view(bool)
+    # unpack the packed bytes into a list of booleans, a byte at a time
+    # True is represented by 1 and False by 0 in the array
+    boolean_array = [
+        bit
+        for byte in packed_bytes[4:4 + (boolean_count + 7) // 8]
+        for bit in _BYTE_BITS[byte]
+    ]
+    del boolean_array[boolean_count:]
     return boolean_array
 
 def convert_from_packed_string_array(packed_bytes):
     string_array = []
-    # packed bytes are decoded and stripped of null characters
-    decoded_hex_string = packed_bytes.decode('utf-8').split('\x00')
+    # packed bytes are decoded and stripped of null characters, every string is null terminated so the last split is empty
+    decoded_hex_string = bytes(packed_bytes).decode('utf-8').split('\x00')[:-1]
     for hex_string in decoded_hex_string:
         # resulting hex string is converted to byte and then to decoded to strings
         string_array.append(bytes.fromhex(hex_string).decode())
     return string_array
 
-def convert_from_packed_datetime_array(packed_bytes):
+def convert_from_packed_datetime_array(packed_bytes, as_view=False):
     # unpack the packed bytes the result will be epoch values
-    epoch_array = convert_from_packed_int64_array(packed_bytes)
+    epoch_array = convert_from_packed_int64_array(packed_bytes, as_view)
     # epoch milliseconds are returned as is
     return epoch_array
\ No newline at end of file
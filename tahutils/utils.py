@@ -1,12 +1,20 @@
+import json
+import os
+import time
 from datetime import datetime
 from enum import Enum
-from typing import Any, Annotated, get_origin, get_args
+from operator import attrgetter
+from typing import Any, Annotated, Iterator, Union, get_origin, get_args
 
 from tahutils.types import MetricName, MetricTimes, Time
 
 from dataclasses import dataclass, is_dataclass, fields
 
 
+def current_time_ms() -> int:
+	"""Returns the current time as integer milliseconds since the epoch, as used for Sparkplug timestamps"""
+	return int(round(time.time() * 1000))
+
 def make_key(*args: Enum, delimiter: str = "/") -> str:
 	l = [e.value if isinstance(e, Enum) else e for e in args]
 	return delimiter.join(l)
@@ -19,25 +27,67 @@ def flatten_data_dict(data: dict[str, Any], convert_enum_keys: bool = True, deli
 		{'a/1': 1, 'a/2': 2, 'b': 3}
 	
 	"""
-	flat = {}
-	for root_key, subtree in data.items():
-		if isinstance(root_key, Enum) and convert_enum_keys:
-			root_key = root_key.value
-
-		if isinstance(subtree, dict):
-			flattened_subtree = flatten_data_dict(subtree)
-			flat.update({
-				f"{root_key}{delimiter}{sub_key}": sub_value
-				for sub_key, sub_value in flattened_subtree.items()
-			})
+	return dict(iter_flatten_data_dict(data, convert_enum_keys, delimiter))
+
+# Joined keys for each (delimiter, parent path), reused across calls since state shapes rarely change between cycles.
+# Child keys other than strings are cached by (type, key), since equal keys of different types (e.g. 1 and True) join differently.
+_JOINED_KEYS: dict[tuple[str, str], dict[Any, str]] = {}
+# Total number of parent paths and joined keys cached, beyond which the cache is cleared
+_JOINED_KEYS_LIMIT = 1 << 16
+_joined_keys_size = 0
+
+def _joined_keys(parent: str, delimiter: str) -> dict[Any, str]:
+	"""Returns the cache of joined keys for children of the parent path"""
+	joined = _JOINED_KEYS.get((delimiter, parent))
+	if joined is None:
+		_reserve_joined_keys()
+		joined = _JOINED_KEYS[(delimiter, parent)] = {}
+	return joined
+
+def _reserve_joined_keys() -> None:
+	"""Counts a new cache entry, clearing the cache first if it is full"""
+	global _joined_keys_size
+	if _joined_keys_size >= _JOINED_KEYS_LIMIT:
+		# Cleared in place, so that caches held by walks in progress are emptied too
+		for joined in _JOINED_KEYS.values():
+			joined.clear()
+		_JOINED_KEYS.clear()
+		_joined_keys_size = 0
+	_joined_keys_size += 1
+
+def iter_flatten_data_dict(data: dict[str, Any], convert_enum_keys: bool = True, delimiter: str = "/") -> Iterator[tuple[str, Any]]:
+	"""Lazily yields the (key, value) pairs of `flatten_data_dict`, walking the nested dicts iteratively"""
+	# Each entry is the parent's joined key (None at the root), its cache of joined child keys, and its remaining items
+	stack = [(None, None, iter(data.items()))]
+	while stack:
+		parent, joined, items = stack[-1]
+		for key, value in items:
+			if convert_enum_keys and isinstance(key, Enum):
+				key = key.value
+			if parent is not None:
+				cache_key = key if type(key) is str else (type(key), key)
+				full_key = joined.get(cache_key)
+				if full_key is None:
+					_reserve_joined_keys()
+					full_key = joined[cache_key] = f"{parent}{delimiter}{key}"
+			else:
+				full_key = key
+
+			if isinstance(value, dict):
+				stack.append((full_key, _joined_keys(full_key, delimiter), iter(value.items())))
+				break
+			yield full_key, value
 		else:
-			flat[root_key] = subtree
-	return flat
+			stack.pop()
+
+def time_to_ms(t: Time) -> int:
+	"""Converts a datetime to milliseconds since the epoch. Integers are assumed to already be in milliseconds."""
+	return int(t.timestamp() * 1000) if isinstance(t, datetime) else t
 
 def process_times(times: MetricTimes) -> dict[str, int]:
 	"""Processes the times dictionary to convert to milliseconds"""
 	r = {
-		metric: int(time.timestamp() * 1000) if isinstance(time, datetime) else time
+		metric: time_to_ms(time)
 		for metric, time in times.items()
 	}
 	return r
@@ -50,16 +100,27 @@ def convert_enum_keys(d: dict[MetricName, Time]) -> dict[str, Any]:
 	}
 	return r
 
+def split_annotated(field_name: str, field_type: Any) -> tuple[str, Any, list[Any]]:
+	"""Splits a possibly Annotated field type into the metric name, the underlying type, and the remaining metadata.
+	The first metadata item is used as the metric name if it is a string or an Enum member, otherwise the first string
+	in the metadata is, otherwise the field name is used."""
+	if get_origin(field_type) is not Annotated:
+		return field_name, field_type, []
+	field_type, *metadata = get_args(field_type)
+	if isinstance(metadata[0], (str, Enum)):
+		return metadata[0], field_type, metadata[1:]
+	for i, m in enumerate(metadata):
+		if isinstance(m, str):
+			return m, field_type, metadata[:i] + metadata[i+1:]
+	return field_name, field_type, metadata
+
 def dataclass_to_dict(cls) -> dict[str, Any]:
 	if not is_dataclass(cls):
 		raise ValueError(f"{cls} is not a dataclass")
 	
 	result = {}
 	for field in fields(cls):
-		field_name, field_type = field.name, field.type
-		if get_origin(field_type) is Annotated:
-			field_type, *metadata = get_args(field_type)
-			field_name = metadata[0]
+		field_name, field_type, _ = split_annotated(field.name, field.type)
 		if is_dataclass(field_type):
 			result[field_name] = dataclass_to_dict(field_type)
 		else:
@@ -73,13 +134,8 @@ def instance_to_dict(instance) -> dict[str, Any]:
 	
 	result = {}
 	for field in fields(instance):
-		field_name, field_value = field.name, getattr(instance, field.name)
-		field_type = field.type
-		
-		# Handle Annotated types
-		if get_origin(field_type) is Annotated:
-			field_type, *metadata = get_args(field_type)
-			field_name = metadata[0]  # Assuming the first metadata argument is the desired field name
+		field_value = getattr(instance, field.name)
+		field_name, field_type, _ = split_annotated(field.name, field.type)
 		
 		# Recursively convert nested dataclasses
 		if field_value is ...:
@@ -89,4 +145,96 @@ def instance_to_dict(instance) -> dict[str, Any]:
 		else:
 			result[field_name] = field_value
 
-	return result
\ No newline at end of file
+	return result
+def dataclass_metadata(cls, kind: type) -> dict[str, Any]:
+	"""Collects the first Annotated metadata item of the given kind for each field, as a nested dict keyed like `dataclass_to_dict`. Fields without one are omitted."""
+	if not is_dataclass(cls):
+		raise ValueError(f"{cls} is not a dataclass")
+
+	result = {}
+	for field in fields(cls):
+		field_name, field_type, metadata = split_annotated(field.name, field.type)
+		if is_dataclass(field_type):
+			nested = dataclass_metadata(field_type, kind)
+			if nested:
+				result[field_name] = nested
+			continue
+		for m in metadata:
+			if isinstance(m, kind):
+				result[field_name] = m
+				break
+
+	return result
+
+def values_equal(a: Any, b: Any) -> bool:
+	"""Compares two metric values. Arrays whose == is elementwise (such as NumPy arrays) are equal when all their elements are."""
+	try:
+		return bool(a == b)
+	except ValueError:
+		try:
+			return len(a) == len(b) and all(x == y for x, y in zip(a, b))
+		except TypeError:
+			return False
+
+class DataclassFlattener:
+	"""Extracts flattened (metric, value) pairs from instances of a dataclass. The metric names and attribute paths are computed once
+	from the class, giving the same result as `flatten_data_dict(instance_to_dict(instance))` without walking the fields on every call."""
+
+	def __init__(self, cls, delimiter: str = "/") -> None:
+		if not is_dataclass(cls):
+			raise ValueError(f"{cls} is not a dataclass")
+		self.cls = cls
+		self.delimiter = delimiter
+		self.paths: list[tuple[str, tuple[str, ...]]] = list(self._paths(cls, "", ()))
+		self._getters = [(metric, attrgetter(".".join(path)), path) for metric, path in self.paths]
+
+	def _paths(self, cls, prefix: str, path: tuple[str, ...]) -> Iterator[tuple[str, tuple[str, ...]]]:
+		for field in fields(cls):
+			metric, field_type, _ = split_annotated(field.name, field.type)
+			if isinstance(metric, Enum):
+				metric = metric.value
+			metric = f"{prefix}{metric}"
+			if is_dataclass(field_type):
+				yield from self._paths(field_type, f"{metric}{self.delimiter}", path + (field.name,))
+			else:
+				yield metric, path + (field.name,)
+
+	def items(self, instance) -> Iterator[tuple[str, Any]]:
+		"""Yields the (metric, value) pairs of the instance, skipping unset (`...`) fields and nested dataclasses.
+		Instances whose values don't match the class's shape, i.e. holding dicts or dataclasses in fields or a dict in place of a nested
+		dataclass, are flattened with `flatten_data_dict(instance_to_dict(instance))` instead."""
+		pairs = []
+		for metric, getter, path in self._getters:
+			try:
+				value = getter(instance)
+			except AttributeError:
+				# Raised when a nested dataclass on the path is unset or replaced, anything else is a genuine error
+				value = instance
+				for name in path:
+					if value is ...:
+						break
+					if not is_dataclass(value):
+						return iter_flatten_data_dict(instance_to_dict(instance), delimiter=self.delimiter)
+					value = getattr(value, name)
+			if value is ...:
+				continue
+			if isinstance(value, dict) or is_dataclass(value):
+				return iter_flatten_data_dict(instance_to_dict(instance), delimiter=self.delimiter)
+			pairs.append((metric, value))
+		return iter(pairs)
+
+	def __call__(self, instance) -> dict[str, Any]:
+		"""Returns the flattened dict of the instance's metric values"""
+		return dict(self.items(instance))
+
+def load_alias_map(path: Union[str, os.PathLike]) -> dict[str, int]:
+	"""Loads a metric -> alias map saved by `save_alias_map`"""
+	with open(path, "r", encoding="utf-8") as f:
+		return {metric: int(alias) for metric, alias in json.load(f).items()}
+
+def save_alias_map(path: Union[str, os.PathLike], aliases: dict[str, int]) -> None:
+	"""Saves a metric -> alias map as JSON ordered by alias. The file is replaced atomically."""
+	tmp_path = f"{os.fspath(path)}.tmp"
+	with open(tmp_path, "w", encoding="utf-8") as f:
+		json.dump(dict(sorted(aliases.items(), key=lambda item: item[1])), f, indent="\t")
+	os.replace(tmp_path, path)
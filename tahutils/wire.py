@@ -0,0 +1,271 @@
+import struct
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Optional, Union
+
+from tahutils.compression import COMPRESSED_UUID, decompress_payload
+from tahutils.encoding import MESSAGE_FIELDS, VALUE_FIELDS
+from tahutils.tahu import sparkplug_b as spb
+
+
+# Protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+def tag(field_number: int, wire_type: int) -> bytes:
+	"""Returns the encoded key of a field"""
+	return encode_varint(field_number << 3 | wire_type)
+
+_SMALL_VARINTS = [bytes((i,)) for i in range(0x80)]
+
+def encode_varint(value: int) -> bytes:
+	"""Encodes a non-negative integer as a varint"""
+	if value < 0x80:
+		if value < 0:
+			raise ValueError(f"Value out of range: {value}")
+		return _SMALL_VARINTS[value]
+	out = bytearray()
+	while value > 0x7f:
+		out.append(value & 0x7f | 0x80)
+		value >>= 7
+	out.append(value)
+	return bytes(out)
+
+def decode_varint(data: bytes, pos: int) -> tuple[int, int]:
+	"""Decodes the varint starting at pos, returning its value and the position after it"""
+	value = 0
+	shift = 0
+	while True:
+		b = data[pos]
+		pos += 1
+		value |= (b & 0x7f) << shift
+		if b < 0x80:
+			return value, pos
+		shift += 7
+
+def skip_field(data: bytes, pos: int, wire_type: int) -> int:
+	"""Returns the position after the value of a field of the wire type starting at pos"""
+	if wire_type == VARINT:
+		return decode_varint(data, pos)[1]
+	if wire_type == LENGTH_DELIMITED:
+		length, pos = decode_varint(data, pos)
+		return pos + length
+	if wire_type == FIXED64:
+		return pos + 8
+	if wire_type == FIXED32:
+		return pos + 4
+	raise ValueError(f"Unsupported wire type {wire_type}")
+
+def _length_delimited(value: bytes) -> bytes:
+	return encode_varint(len(value)) + value
+
+_pack_float = struct.Struct("<f").pack
+_pack_double = struct.Struct("<d").pack
+
+# Payload fields
+PAYLOAD_TIMESTAMP = tag(1, VARINT)
+PAYLOAD_METRIC = tag(2, LENGTH_DELIMITED)
+PAYLOAD_SEQ = tag(3, VARINT)
+PAYLOAD_UUID = tag(4, LENGTH_DELIMITED)
+
+# Metric fields
+METRIC_NAME = tag(1, LENGTH_DELIMITED)
+METRIC_ALIAS = tag(2, VARINT)
+METRIC_TIMESTAMP = tag(3, VARINT)
+METRIC_DATATYPE = tag(4, VARINT)
+METRIC_IS_NULL = tag(7, VARINT) + encode_varint(1)
+
+def _uint_writer(key: bytes, bits: int) -> Callable[[int], bytes]:
+	"""Returns a writer of an unsigned varint field, raising the same error as protobuf for values outside its range"""
+	limit = 1 << bits
+	def write(value: int) -> bytes:
+		if not 0 <= value < limit:
+			raise ValueError(f"Value out of range: {value}")
+		return key + encode_varint(value)
+	return write
+
+# Encodes each Metric value field, keyed by field name, as its key followed by the value
+_VALUE_WRITERS: dict[str, Callable[[Any], bytes]] = {
+	"int_value": _uint_writer(tag(10, VARINT), 32),
+	"long_value": _uint_writer(tag(11, VARINT), 64),
+	"float_value": lambda v, t=tag(12, FIXED32): t + _pack_float(v),
+	"double_value": lambda v, t=tag(13, FIXED64): t + _pack_double(v),
+	"boolean_value": lambda v, t=tag(14, VARINT): t + (b"\x01" if v else b"\x00"),
+	"string_value": lambda v, t=tag(15, LENGTH_DELIMITED): t + _length_delimited(v.encode("utf-8")),
+	"bytes_value": lambda v, t=tag(16, LENGTH_DELIMITED): t + _length_delimited(bytes(v)),
+}
+
+
+class WirePayload:
+	"""A payload being written directly in the protobuf wire format. The payload timestamp is written on creation,
+	each metric as it is added, and the sequence number (the highest numbered field) when finished."""
+	__slots__ = ("timestamp", "seq", "buffer", "_metric_timestamp", "_metric_timestamp_bytes", "metric_count")
+
+	def __init__(self, timestamp: int, seq: int, buffer: Optional[bytearray] = None) -> None:
+		self.timestamp = timestamp
+		self.seq = seq
+		self.buffer = buffer if buffer is not None else bytearray()
+		self.buffer.clear()
+		self.buffer += PAYLOAD_TIMESTAMP
+		self.buffer += encode_varint(timestamp)
+		# Metrics in a payload are usually stamped with the same time, so the last encoded metric timestamp is kept
+		self._metric_timestamp = None
+		self._metric_timestamp_bytes = b""
+		self.metric_count = 0
+
+	def finish(self) -> bytearray:
+		"""Writes the sequence number and returns the buffer holding the serialized payload"""
+		self.buffer += PAYLOAD_SEQ
+		self.buffer += encode_varint(self.seq)
+		return self.buffer
+
+
+@dataclass(frozen=True, slots=True)
+class WireMetric:
+	"""Precompiled wire encoding of a single metric. The name and alias are encoded once, leaving only the timestamp and value per payload.
+	A drop-in replacement for `MetricEncoder` when writing to a `WirePayload`."""
+	name: Optional[str]
+	alias: Optional[int]
+	datatype: int
+	head: bytes
+	datatype_bytes: bytes
+	write: Callable[[Any], bytes]
+	convert: Optional[Callable[[Any], Any]] = None
+
+	def encode(self, container: WirePayload, value: Any, timestamp: Optional[int] = None) -> None:
+		"""Writes the metric with the given value to the payload. A value of `None` is sent as a null metric."""
+		if timestamp is None:
+			stamp = b""
+		elif timestamp == container._metric_timestamp:
+			stamp = container._metric_timestamp_bytes
+		else:
+			stamp = container._metric_timestamp_bytes = METRIC_TIMESTAMP + encode_varint(timestamp)
+			container._metric_timestamp = timestamp
+		if value is None:
+			value = METRIC_IS_NULL
+		elif self.convert is None:
+			value = self.write(value)
+		else:
+			value = self.write(self.convert(value))
+		body = b"".join((self.head, stamp, self.datatype_bytes, value))
+		buffer = container.buffer
+		buffer += PAYLOAD_METRIC
+		buffer += encode_varint(len(body))
+		buffer += body
+		container.metric_count += 1
+
+
+def compile_wire_metric(name: Optional[str], alias: Optional[int], datatype: int) -> WireMetric:
+	"""Compiles a WireMetric for the given metric. Raises a ValueError for datatypes that can't be written directly, i.e. DataSets and Templates."""
+	if datatype not in VALUE_FIELDS:
+		raise ValueError(f"Unsupported metric data type {datatype} for metric {name}")
+	field, convert = VALUE_FIELDS[datatype]
+	if field in MESSAGE_FIELDS:
+		raise ValueError(f"Metric {name} of data type {datatype} can't be wire encoded")
+	head = b""
+	if name is not None:
+		head += METRIC_NAME + _length_delimited(name.encode("utf-8"))
+	if alias is not None:
+		head += METRIC_ALIAS + encode_varint(alias)
+	return WireMetric(
+		name=name,
+		alias=alias,
+		datatype=datatype,
+		head=head,
+		datatype_bytes=METRIC_DATATYPE + encode_varint(datatype),
+		write=_VALUE_WRITERS[field],
+		convert=convert
+	)
+
+
+class WireEncoder:
+	"""Creates wire payloads, each writing into a bytearray of its own. Serialized payloads can then be handed on without copying,
+	since no later payload writes into them."""
+
+	def payload(self, timestamp: int, seq: int) -> WirePayload:
+		"""Starts a new payload"""
+		return WirePayload(timestamp, seq)
+
+
+_PAYLOAD_METRIC_KEY = PAYLOAD_METRIC[0]
+_PAYLOAD_UUID_KEY = PAYLOAD_UUID[0]
+_METRIC_NAME_KEY = METRIC_NAME[0]
+_METRIC_ALIAS_KEY = METRIC_ALIAS[0]
+_COMPRESSED_UUID = COMPRESSED_UUID.encode("utf-8")
+
+class WireFilter:
+	"""Keeps or drops the metrics of serialized payloads by name or alias, and optionally rewrites their aliases, without decoding them.
+
+	Metrics matching `names` or `aliases` are kept, or dropped if `exclude` is set. Without either, every metric is kept.
+	Names are only present in births (and data payloads not using aliases), so filters for aliased data payloads should match on aliases.
+	Aliases found in `realias` are replaced with the alias they map to. Every other byte of the payload is copied unchanged.
+	Compressed payloads are decompressed, and the result is not compressed again.
+	"""
+
+	def __init__(
+			self,
+			names: Optional[Iterable[str]] = None,
+			aliases: Optional[Iterable[int]] = None,
+			exclude: bool = False,
+			realias: Optional[dict[int, int]] = None
+		) -> None:
+		self.names = frozenset(name.encode("utf-8") for name in names) if names is not None else None
+		self.aliases = frozenset(aliases) if aliases is not None else None
+		self.exclude = exclude
+		self.realias = dict(realias or {})
+		self._alias_fields = {old: METRIC_ALIAS + encode_varint(new) for old, new in self.realias.items()}
+		self._filtering = names is not None or aliases is not None
+
+	def __call__(self, data: Union[bytes, bytearray, memoryview]) -> bytes:
+		"""Returns the filtered payload"""
+		data = bytes(data)
+		filtering, exclude = self._filtering, self.exclude
+		names = self.names or frozenset()
+		aliases = self.aliases or frozenset()
+		alias_fields = self._alias_fields
+		out = []
+		# Unchanged bytes are copied in runs, starting at run_start
+		run_start = 0
+		pos, end = 0, len(data)
+		while pos < end:
+			start = pos
+			key, pos = decode_varint(data, pos)
+			if key == _PAYLOAD_UUID_KEY:
+				length, pos = decode_varint(data, pos)
+				if data[pos:pos + length] == _COMPRESSED_UUID:
+					return self(decompress_payload(spb.Payload.FromString(data)).SerializeToString())
+				pos += length
+				continue
+			if key != _PAYLOAD_METRIC_KEY:
+				pos = skip_field(data, pos, key & 7)
+				continue
+
+			length = data[pos]
+			if length < 0x80:
+				body_start = pos + 1
+			else:
+				length, body_start = decode_varint(data, pos)
+			pos = body_start + length
+
+			# Protobuf serializers write fields in field number order, so the name and alias (fields 1 and 2) come first
+			name = alias = None
+			p = body_start
+			if p < pos and data[p] == _METRIC_NAME_KEY:
+				name_length, p = decode_varint(data, p + 1)
+				name = data[p:p + name_length]
+				p += name_length
+			if p < pos and data[p] == _METRIC_ALIAS_KEY:
+				alias_start = p
+				alias, alias_end = decode_varint(data, p + 1)
+
+			if filtering and (name in names or alias in aliases) == exclude:
+				out.append(data[run_start:start])
+				run_start = pos
+			elif alias in alias_fields:
+				body = b"".join((data[body_start:alias_start], alias_fields[alias], data[alias_end:pos]))
+				out.append(data[run_start:start])
+				out.append(PAYLOAD_METRIC + encode_varint(len(body)) + body)
+				run_start = pos
+		out.append(data[run_start:end])
+		return b"".join(out)